@@ -1,5 +1,6 @@
 import os
 import time
+import concurrent.futures
 import numpy as np
 
 import tensorflow as tf
@@ -9,6 +10,50 @@ import matplotlib.pyplot as plt
 from IPython.display import clear_output
 
 from resnet.ResNet import ResNet_Blocks
+from utilities.precision import set_mixed_precision_policy
+
+def is_url(image_path):
+  return image_path.startswith(('http://', 'https://'))
+
+def fetch_remote(url):
+  """Gets an image file from url and caches it locally.
+  Returns the local file path.
+  """
+  return tf.keras.utils.get_file(os.path.basename(url)[-128:], url)
+
+def resolve_paths(image_paths, max_workers=8):
+  """Fetches the urls in image_paths in parallel and returns a list of local file paths.
+  arguments:
+    image_paths: List of file paths or urls.
+    max_workers: Int. Number of concurrent downloads.
+  """
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    return list(executor.map(lambda path: fetch_remote(path) if is_url(path) else path, image_paths))
+
+def load_local(image_path, channels=3):
+  """Loads images from a local file as uint8.
+  The pixels stay uint8 through the input pipeline and are converted by to_float on the device.
+  arguments:
+    image_path: String. File path to read from.
+    channels: Int. Number of channels of images.
+  """
+  return tf.io.decode_image(tf.io.read_file(image_path), channels=channels, dtype=tf.uint8, expand_animations=False)
+
+def to_float(images):
+  """Converts uint8 images to float32 in range [-1, 1]."""
+  return tf.cast(images, tf.float32) * (1.0/127.5) - 1.0
+
+def has_batch_norm(model):
+  """Returns True if model has a BatchNormalization layer, whose training output depends on the whole batch."""
+  return any(isinstance(layer, tf.keras.layers.BatchNormalization) for layer in model.submodules)
+
+def resize_uint8(images, size):
+  """Resizes uint8 images and rounds them back to uint8."""
+  return tf.saturate_cast(tf.round(tf.image.resize(images, size)), tf.uint8)
+
+def load_remote(url, channels=3):
+  """Loads and preprocesses images from a url, which is cached locally."""
+  return load_local(fetch_remote(url), channels)
 
 def load_image(image_path, channels=3):
   """Loads and preprocesses images.
@@ -16,61 +61,198 @@ def load_image(image_path, channels=3):
     image_path: String. File path or url to read from. If set url, the url must start with "http" or "https.
     channels: Int. Number of channels of images.
   """
-  if 'http' in image_path:
-    # Get image file from url and cache locally.
-    image_path = tf.keras.utils.get_file(os.path.basename(image_path)[-128:], image_path)
-
-  # Load and convert to float32 numpy array, and normalize to range [0, 1].
-  image = tf.io.decode_image(tf.io.read_file(image_path), channels=channels, dtype=tf.float32,)
-  # Normalize to range [-1, 1]
-  image = image*2.0-1.0
-  return image
-
-def random_crop_images(dataset, image_size=(64, 64), expand=1.1):
-  height, width = image_size
-  ex_size = ex_height, ex_width = tuple([int(x*expand) for x in image_size])
-  offset_height = np.random.randint(0, ex_height-height)
-  offset_width = np.random.randint(0, ex_width-width)
-
-  dataset = dataset.map(lambda x: tf.image.resize(x, ex_size))
-  dataset = dataset.map(lambda x: tf.image.crop_to_bounding_box(x, offset_height, offset_width, height, width))
-  return dataset
+  if is_url(image_path):
+    return load_remote(image_path, channels)
+  return load_local(image_path, channels)
 
-def random_flip_left_right_images(dataset):
-  if np.random.randint(2):
-    dataset = dataset.map(lambda x: tf.image.flip_left_right(x))
-  return dataset
+def random_crop_and_flip(images, seed, image_size=(64, 64), expand=1.1):
+  """Randomly crops and horizontally flips a stack of images with one crop and one flip.
+  The random ops are stateless, so the result only depends on the seed.
+
+  arguments:
+    images: uint8 tensor with the shape (num_images, height, width, channels), e.g. an original and its target stacked together.
+    seed: Tensor with the shape (2,). Seed for the stateless random ops.
+    image_size: Tuple. Image size of the output with the shape of (height, width).
+    expand: Float. Scale to resize the images by before cropping.
+  """
+  ex_size = [int(x*expand) for x in image_size]
+  seeds = tf.random.experimental.stateless_split(seed, num=2)
+
+  images = resize_uint8(images, ex_size)
+  images = tf.image.stateless_random_crop(images, (images.shape[0], *image_size, images.shape[-1]), seed=seeds[0])
+  flip = tf.random.stateless_uniform([], seed=seeds[1]) < 0.5
+  images = tf.cond(flip, lambda: tf.image.flip_left_right(images), lambda: images)
+  return images
+
+def augment_dataset(images_x, images_y, seed, image_size=(64, 64), aug_num=5, expand=1.1):
+  """Builds a dataset of augmented (original, target) pairs.
+  Each pair is repeated aug_num times and both images get the same crop and flip in a single parallel map.
+
+  arguments:
+    images_x: Array of original images with the shape (num_images, height, width, channels).
+    images_y: Array of target images with the shape (num_images, height, width, channels).
+    seed: Int. Base seed for the augmentation. The seed of each pair is derived from it and the index of the pair.
+    image_size: Tuple. Image size of the output with the shape of (height, width).
+    aug_num: Int. Number of augmented pairs per pair.
+    expand: Float. Scale to resize the images by before cropping.
+  """
+  dataset = augment_pairs(tf.data.Dataset.from_tensor_slices((images_x, images_y)), seed, image_size, aug_num, expand)
+  # The augmentation is deterministic, so cache it after the first epoch.
+  return dataset.cache()
+
+def augment_pairs(dataset, seed, image_size=(64, 64), aug_num=5, expand=1.1):
+  """Repeats a dataset of (original, target) pairs aug_num times and gives both images of each pair the same crop and flip.
+  arguments:
+    dataset: tf.data.Dataset of (original, target) pairs.
+    seed: Int. Base seed for the augmentation. The seed of each pair is derived from it and the index of the pair.
+    image_size: Tuple. Image size of the output with the shape of (height, width).
+    aug_num: Int. Number of augmented pairs per pair.
+    expand: Float. Scale to resize the images by before cropping.
+  """
+  def augment(i, pair):
+    images = random_crop_and_flip(tf.stack(pair), tf.stack([tf.cast(seed, tf.int64), i]), image_size, expand)
+    return images[0], images[1]
+
+  dataset = dataset.repeat(aug_num).enumerate()
+  return dataset.map(augment, num_parallel_calls=tf.data.AUTOTUNE)
+
+def batch_pairs(dataset, batch_size, shuffle_buffer, seed=None):
+  """Shuffles, batches and prefetches a dataset of (original, target) pairs.
+  Both images of a pair stay in one element, so a single iterator and prefetch buffer feed the training.
+  arguments:
+    dataset: tf.data.Dataset of (original, target) pairs.
+    batch_size: Int. Batch size.
+    shuffle_buffer: Int. Size of the shuffle buffer.
+    seed: Int. Seed of the shuffle.
+  """
+  options = tf.data.Options()
+  options.experimental_optimization.map_and_batch_fusion = True
+  # The order of the elements is random anyway, so let the parallel stages return them as they are ready.
+  options.deterministic = False
+
+  dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+  # Drop the last partial batch, so that every batch has the same static shape
+  # and the jit compiled train step is not traced and compiled again for it.
+  return dataset.batch(batch_size, drop_remainder=True).prefetch(tf.data.AUTOTUNE).with_options(options)
 
-def load_and_preprocessing_data(paths_x, paths_y, image_size=(64, 64), batch_size=5, channels=3, aug_num=5, expand=1.1):
-  prep_images=[]
+def to_tfrecord(out_path, paths_x, paths_y, image_size=(64, 64), channels=3):
+  """Decodes and resizes the (original, target) pairs once and writes them to a TFRecord file,
+  so that later runs read them back with load_tfrecord instead of decoding every source image again.
+  The pixels are stored as raw uint8.
+
+  arguments:
+    out_path: String. Path of the TFRecord file to write.
+    paths_x: List of file paths or urls of original images.
+    paths_y: List of file paths or urls of target images.
+    image_size: Tuple. Image size to store with the shape of (height, width).
+    channels: Int. Number of channels of images.
+
+  Returns:
+    out_path
+  """
+  paths_x = resolve_paths(paths_x)
+  paths_y = resolve_paths(paths_y)
+
+  def bytes_feature(image):
+    image = resize_uint8(image, image_size)
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.numpy().tobytes()]))
+
+  with tf.io.TFRecordWriter(out_path) as writer:
+    for path_x, path_y in zip(paths_x, paths_y):
+      example = tf.train.Example(features=tf.train.Features(feature={
+          'image_x': bytes_feature(load_local(path_x, channels)),
+          'image_y': bytes_feature(load_local(path_y, channels)),
+      }))
+      writer.write(example.SerializeToString())
+
+  print('Wrote', min(len(paths_x), len(paths_y)), 'pairs to', out_path)
+  return out_path
+
+def load_tfrecord(shards, image_size=(64, 64), batch_size=5, channels=3, aug_num=5, expand=1.1, seed=None, shuffle_buffer=1000):
+  """Loads the (original, target) pairs written by to_tfrecord and augments them like load_and_preprocessing_data.
+  arguments:
+    shards: String or list of strings. Paths of the TFRecord files, which are read in parallel.
+    image_size: Tuple. Image size the files were written with, which is also the output size.
+    batch_size: Int. Batch size.
+    channels: Int. Number of channels of images.
+    aug_num: Int. Number of augmented pairs per pair.
+    expand: Float. Scale to resize the images by before cropping.
+    seed: Int. Base seed for the augmentation. Random if None.
+    shuffle_buffer: Int. Size of the shuffle buffer.
+
+  Returns:
+    Dataset of batched (original, target) pairs.
+  """
+  feature_description = {
+      'image_x': tf.io.FixedLenFeature([], tf.string),
+      'image_y': tf.io.FixedLenFeature([], tf.string),
+  }
+
+  def parse(record):
+    features = tf.io.parse_single_example(record, feature_description)
+    decode = lambda data: tf.reshape(tf.io.decode_raw(data, tf.uint8), (*image_size, channels))
+    return decode(features['image_x']), decode(features['image_y'])
+
+  if seed is None:
+    seed = np.random.randint(2**31)
+
+  if isinstance(shards, str):
+    shards = [shards]
+
+  dataset = tf.data.Dataset.from_tensor_slices(shards)
+  dataset = dataset.interleave(tf.data.TFRecordDataset, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+  dataset = dataset.map(parse, num_parallel_calls=tf.data.AUTOTUNE)
+  dataset = augment_pairs(dataset, seed, image_size, aug_num, expand)
+
+  return batch_pairs(dataset, batch_size, shuffle_buffer, seed)
+
+def load_and_preprocessing_data(paths_x, paths_y, image_size=(64, 64), batch_size=5, channels=3, aug_num=5, expand=1.1, seed=None):
+  """Loads and augments the (original, target) pairs for CycleGanTraining.train.
+
+  Returns:
+    Dataset of batched (original, target) pairs. The last partial batch is dropped.
+    Raises ValueError if there is not a single full batch.
+  """
   print('Number of files to load for original:', len(paths_x))
   print('Number of files to load for target:', len(paths_y))
 
-  dataset_x = tf.data.Dataset.from_tensor_slices([])
-  dataset_y = tf.data.Dataset.from_tensor_slices([])
-  for path_x, path_y in zip(paths_x, paths_y):
-    image_x = tf.image.resize(load_image(path_x, channels), image_size)
-    image_y = tf.image.resize(load_image(path_y, channels), image_size)
-    for _ in range(aug_num):
-      dataset_aug = tf.data.Dataset.from_tensor_slices([[image_x, image_y]])
-      dataset_aug = random_crop_images(dataset_aug, image_size, expand)
-      dataset_aug = random_flip_left_right_images(dataset_aug)
-      x, y = next(iter(dataset_aug))
-      dataset_x = dataset_x.concatenate(tf.data.Dataset.from_tensor_slices([x]))
-      dataset_y = dataset_y.concatenate(tf.data.Dataset.from_tensor_slices([y]))
-
-  print('Total Number of Images:',len(dataset_x))
-  buffer_size = len(dataset_x)
-
-  dataset_x = dataset_x.batch(batch_size)
-  dataset_y = dataset_y.batch(batch_size)
+  # Download any urls up front so the loading loop only reads local files.
+  paths_x = resolve_paths(paths_x)
+  paths_y = resolve_paths(paths_y)
+
+  # Preallocate the buffers and build each dataset once instead of concatenating per image.
+  num_images = min(len(paths_x), len(paths_y))
+  # The last partial batch is dropped, so fewer pairs than batch_size would give an empty dataset.
+  if num_images * aug_num < batch_size:
+    raise ValueError('{} pairs x aug_num {} gives less than one batch of {}'.format(num_images, aug_num, batch_size))
+
+  buf_x = np.empty((num_images, *image_size, channels), np.uint8)
+  buf_y = np.empty((num_images, *image_size, channels), np.uint8)
+
+  for i, (path_x, path_y) in enumerate(zip(paths_x, paths_y)):
+    buf_x[i] = resize_uint8(load_local(path_x, channels), image_size).numpy()
+    buf_y[i] = resize_uint8(load_local(path_y, channels), image_size).numpy()
+
+  print('Total Number of Images:', num_images * aug_num)
+
+  if seed is None:
+    seed = np.random.randint(2**31)
+  dataset = augment_dataset(buf_x, buf_y, seed, image_size, aug_num, expand)
+
+  # The augmented pairs are kept in memory, so shuffle all of them.
+  dataset = batch_pairs(dataset, batch_size, num_images * aug_num, seed)
 
   print('Batch size:',batch_size)
-  print('Num batchs', len(dataset_x))
+  print('Num batchs', len(dataset))
+
+  return dataset
 
-  return dataset_x, dataset_y
+class CycleGanTraining(tf.keras.Model):
+  """CycleGAN training loop as a Keras model.
+  train_step implements one optimization step of the two generators and the two discriminators,
+  so training runs through Model.fit, which compiles the step, prefetches the batches and distributes them.
+  """
 
-class CycleGanTraining():
   def __init__(self,
                generator_g, # Tf.Model, generator model.
                generator_f, # Tf.Model, generator model.
@@ -80,24 +262,53 @@ class CycleGanTraining():
                beta_1 = 0.5,
                beta_2 = 0.999,
                checkpoint_prefix = None,
+               strategy = None, # tf.distribute.Strategy, e.g. tf.distribute.MirroredStrategy(). The models must be built in its scope.
+               accum_steps = 1, # Number of micro-batches each batch is split into. The batch size must be divisible by it.
+               sample_every = 10, # Show a sample image every this many epochs.
                ):
 
-    self.generator_g = generator_g
-    self.generator_f = generator_f
-    self.discriminator_x = discriminator_x
-    self.discriminator_y = discriminator_y
-
-    self.LAMBDA = 10
-    self.loss_obj = tf.keras.losses.BinaryCrossentropy(from_logits=True)
-
-    # Define the generator optimizers
-    # The generator optimizers are different since you will train two networks separately.
-    self.generator_g_optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=beta_1)
-    self.generator_f_optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=beta_1)
-    # Define the discriminator optimizers
-    # The discriminator optimizers are different since you will train two networks separately.
-    self.discriminator_x_optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=beta_1)
-    self.discriminator_y_optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=beta_1)
+    # Keras takes the distribution strategy of the model from the scope it is created and compiled in.
+    with (strategy or tf.distribute.get_strategy()).scope():
+      super().__init__()
+
+      self.accum_steps = accum_steps
+      self.sample_every = sample_every
+      self.checkpoint_prefix = checkpoint_prefix
+
+      self.generator_g = generator_g
+      self.generator_f = generator_f
+      self.discriminator_x = discriminator_x
+      self.discriminator_y = discriminator_y
+
+      self.LAMBDA = 10
+      # The losses are reduced per example and averaged over the global batch by average_loss.
+      self.loss_obj = tf.keras.losses.BinaryCrossentropy(from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
+
+      # Define the generator optimizers
+      # The generator optimizers are different since you will train two networks separately.
+      self.generator_g_optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=beta_1)
+      self.generator_f_optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=beta_1)
+      # Define the discriminator optimizers
+      # The discriminator optimizers are different since you will train two networks separately.
+      self.discriminator_x_optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=beta_1)
+      self.discriminator_y_optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, beta_1=beta_1)
+
+      # Loss scaling keeps float16 gradients from underflowing. bfloat16 has the range of float32 and does not need it.
+      self.loss_scale = tf.keras.mixed_precision.global_policy().compute_dtype == 'float16'
+      if self.loss_scale:
+        self.generator_g_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(self.generator_g_optimizer)
+        self.generator_f_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(self.generator_f_optimizer)
+        self.discriminator_x_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(self.discriminator_x_optimizer)
+        self.discriminator_y_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(self.discriminator_y_optimizer)
+
+      # Mean losses over each epoch, aggregated over the replicas.
+      self.disc_loss_tracker = tf.keras.metrics.Mean(name='disc_loss')
+      self.gen_loss_tracker = tf.keras.metrics.Mean(name='gen_loss')
+
+      # The whole train_step, including the optimizer updates, is compiled with XLA.
+      # compile takes a single optimizer; the one of generator G is passed so that no unused default
+      # optimizer is created. train_step applies all four optimizers above.
+      self.compile(optimizer=self.generator_g_optimizer, run_eagerly=False, jit_compile=True)
 
     self.checkpoint = tf.train.Checkpoint(
         generator_g = generator_g,
@@ -110,27 +321,46 @@ class CycleGanTraining():
         discriminator_y_optimizer = self.discriminator_y_optimizer,
         )
 
+  @property
+  def metrics(self):
+    # Listed here so that fit resets them at the start of each epoch.
+    return [self.disc_loss_tracker, self.gen_loss_tracker]
+
+  def average_loss(self, per_example_loss):
+    # Mean over all but the batch axis, then average over the global batch of all replicas.
+    per_example_loss = tf.reduce_mean(per_example_loss, axis=list(range(1, per_example_loss.shape.rank)))
+    return tf.nn.compute_average_loss(per_example_loss)
 
   def discriminator_loss(self, real, generated):
-    real_loss = self.loss_obj(tf.ones_like(real), real)
+    real_loss = self.average_loss(self.loss_obj(tf.ones_like(real), real))
 
-    generated_loss = self.loss_obj(tf.zeros_like(generated), generated)
+    generated_loss = self.average_loss(self.loss_obj(tf.zeros_like(generated), generated))
 
     total_disc_loss = real_loss + generated_loss
 
     return total_disc_loss * 0.5
 
   def generator_loss(self, generated):
-    return self.loss_obj(tf.ones_like(generated), generated)
+    return self.average_loss(self.loss_obj(tf.ones_like(generated), generated))
 
   def calc_cycle_loss(self, real_image, cycled_image):
-    loss1 = tf.reduce_mean(tf.abs(real_image - cycled_image))
+    loss1 = self.average_loss(tf.abs(real_image - cycled_image))
     return self.LAMBDA * loss1
 
   def identity_loss(self, real_image, same_image):
-    loss = tf.reduce_mean(tf.abs(real_image - same_image))
+    loss = self.average_loss(tf.abs(real_image - same_image))
     return self.LAMBDA * 0.5 * loss
 
+  def scaled_loss(self, optimizer, loss):
+    if self.loss_scale:
+      return optimizer.get_scaled_loss(loss)
+    return loss
+
+  def unscaled_gradients(self, optimizer, gradients):
+    if self.loss_scale:
+      return optimizer.get_unscaled_gradients(gradients)
+    return gradients
+
   def generate_images(self, model, test_input):
     prediction = model(test_input)
 
@@ -147,7 +377,8 @@ class CycleGanTraining():
       plt.axis('off')
     plt.show()
 
-  def save(self, checkpoint_prefix=None):
+  def save_checkpoints(self, checkpoint_prefix=None):
+    # Not named save, which would shadow Model.save used by ModelCheckpoint.
     if checkpoint_prefix:
       return self.checkpoint.save(file_prefix=checkpoint_prefix)
     elif self.checkpoint_prefix:
@@ -158,138 +389,310 @@ class CycleGanTraining():
   def restore(self, save_path):
     return self.checkpoint.restore(save_path)
 
-  @tf.function
-  def train_step(self, real_x, real_y):
-    # persistent is set to True because the tape is used more than
-    # once to calculate the gradients.
-    with tf.GradientTape(persistent=True) as tape:
+  def paired_call(self, model, a, b):
+    """Returns model(a) and model(b) in training mode.
+    Without batch norm, both run in one call on the concatenated batch. With batch norm, a and b would then
+    share their batch statistics, so they are run separately. This is decided when the step is traced.
+    """
+    if has_batch_norm(model):
+      return model(a, training=True), model(b, training=True)
+    return tf.split(model(tf.concat([a, b], 0), training=True), 2)
+
+  def compute_micro_batch_gradients(self, real_x, real_y):
+    # One tape per network. Each tape only watches the variables it differentiates, so none of them
+    # has to be persistent, and each network's loss is scaled with the loss scale of its own optimizer.
+    with tf.GradientTape(watch_accessed_variables=False) as gen_g_tape, \
+         tf.GradientTape(watch_accessed_variables=False) as gen_f_tape, \
+         tf.GradientTape(watch_accessed_variables=False) as disc_x_tape, \
+         tf.GradientTape(watch_accessed_variables=False) as disc_y_tape:
+      gen_g_tape.watch(self.generator_g.trainable_variables)
+      gen_f_tape.watch(self.generator_f.trainable_variables)
+      disc_x_tape.watch(self.discriminator_x.trainable_variables)
+      disc_y_tape.watch(self.discriminator_y.trainable_variables)
+
       # Generator G translates X -> Y
       # Generator F translates Y -> X.
+      # same_x and same_y are used for identity loss. Without batch norm they are computed in the same
+      # generator call as the translation, so each generator runs twice instead of three times.
 
-      fake_y = self.generator_g(real_x, training=True)
-      cycled_x = self.generator_f(fake_y, training=True)
+      fake_y, same_y = self.paired_call(self.generator_g, real_x, real_y)
+      fake_x, same_x = self.paired_call(self.generator_f, real_y, real_x)
 
-      fake_x = self.generator_f(real_y, training=True)
+      cycled_x = self.generator_f(fake_y, training=True)
       cycled_y = self.generator_g(fake_x, training=True)
 
-      # same_x and same_y are used for identity loss.
-      same_x = self.generator_f(real_x, training=True)
-      same_y = self.generator_g(real_y, training=True)
-
-      disc_real_x = self.discriminator_x(real_x, training=True)
-      disc_real_y = self.discriminator_y(real_y, training=True)
-
-      disc_fake_x = self.discriminator_x(fake_x, training=True)
-      disc_fake_y = self.discriminator_y(fake_y, training=True)
+      # The real and the fake images go through each discriminator in one call as well, unless it has
+      # batch norm: mixing real and fake batch statistics would let it tell them apart by the statistics.
+      disc_real_x, disc_fake_x = self.paired_call(self.discriminator_x, real_x, fake_x)
+      disc_real_y, disc_fake_y = self.paired_call(self.discriminator_y, real_y, fake_y)
 
       # calculate the loss
       gen_g_loss = self.generator_loss(disc_fake_y)
       gen_f_loss = self.generator_loss(disc_fake_x)
 
       total_cycle_loss = self.calc_cycle_loss(real_x, cycled_x) + self.calc_cycle_loss(real_y, cycled_y)
+      identity_x_loss = self.identity_loss(real_x, same_x)
+      identity_y_loss = self.identity_loss(real_y, same_y)
 
       # Total generator loss = adversarial loss + cycle loss
-      total_gen_g_loss = gen_g_loss + total_cycle_loss + self.identity_loss(real_y, same_y)
-      total_gen_f_loss = gen_f_loss + total_cycle_loss + self.identity_loss(real_x, same_x)
+      total_gen_g_loss = gen_g_loss + total_cycle_loss + identity_y_loss
+      total_gen_f_loss = gen_f_loss + total_cycle_loss + identity_x_loss
 
       disc_x_loss = self.discriminator_loss(disc_real_x, disc_fake_x)
       disc_y_loss = self.discriminator_loss(disc_real_y, disc_fake_y)
 
-    # Calculate the gradients for generator and discriminator
-    generator_g_gradients = tape.gradient(total_gen_g_loss,
-                                          self.generator_g.trainable_variables)
-    generator_f_gradients = tape.gradient(total_gen_f_loss,
-                                          self.generator_f.trainable_variables)
+      # Scale the losses for mixed precision, each with the loss scale of the optimizer that
+      # applies its gradients, so every LossScaleOptimizer checks and adjusts the scale it was used with.
+      scaled_gen_g_loss = self.scaled_loss(self.generator_g_optimizer, total_gen_g_loss)
+      scaled_gen_f_loss = self.scaled_loss(self.generator_f_optimizer, total_gen_f_loss)
+      scaled_disc_x_loss = self.scaled_loss(self.discriminator_x_optimizer, disc_x_loss)
+      scaled_disc_y_loss = self.scaled_loss(self.discriminator_y_optimizer, disc_y_loss)
 
-    discriminator_x_gradients = tape.gradient(disc_x_loss,
-                                              self.discriminator_x.trainable_variables)
-    discriminator_y_gradients = tape.gradient(disc_y_loss,
-                                              self.discriminator_y.trainable_variables)
+    # Calculate the gradients for generator and discriminator
+    generator_gradients = (
+        self.unscaled_gradients(self.generator_g_optimizer,
+                                gen_g_tape.gradient(scaled_gen_g_loss, self.generator_g.trainable_variables)) +
+        self.unscaled_gradients(self.generator_f_optimizer,
+                                gen_f_tape.gradient(scaled_gen_f_loss, self.generator_f.trainable_variables)))
+
+    discriminator_gradients = (
+        self.unscaled_gradients(self.discriminator_x_optimizer,
+                                disc_x_tape.gradient(scaled_disc_x_loss, self.discriminator_x.trainable_variables)) +
+        self.unscaled_gradients(self.discriminator_y_optimizer,
+                                disc_y_tape.gradient(scaled_disc_y_loss, self.discriminator_y.trainable_variables)))
+
+    return [disc_x_loss, total_gen_g_loss], generator_gradients, discriminator_gradients
+
+  def compute_gradients(self, real_x, real_y):
+    if self.accum_steps == 1:
+      return self.compute_micro_batch_gradients(real_x, real_y)
+
+    # Gradient accumulation: the batch is split into accum_steps micro-batches which are processed
+    # one after another in a while loop, so only the activations of one micro-batch are alive at a time.
+    micro_shape = tf.concat([[self.accum_steps, -1], tf.shape(real_x)[1:]], axis=0)
+    micro_x = tf.reshape(real_x, micro_shape)
+    micro_y = tf.reshape(real_y, micro_shape)
+
+    def body(i, losses, generator_gradients, discriminator_gradients):
+      step_losses, step_generator_gradients, step_discriminator_gradients = self.compute_micro_batch_gradients(micro_x[i], micro_y[i])
+      return (i + 1,
+              [a + b for a, b in zip(losses, step_losses)],
+              [a + b for a, b in zip(generator_gradients, step_generator_gradients)],
+              [a + b for a, b in zip(discriminator_gradients, step_discriminator_gradients)])
+
+    generator_variables = self.generator_g.trainable_variables + self.generator_f.trainable_variables
+    discriminator_variables = self.discriminator_x.trainable_variables + self.discriminator_y.trainable_variables
+    _, losses, generator_gradients, discriminator_gradients = tf.while_loop(
+        lambda i, *_: i < self.accum_steps,
+        body,
+        (tf.constant(0),
+         [tf.zeros([]), tf.zeros([])],
+         [tf.zeros_like(v) for v in generator_variables],
+         [tf.zeros_like(v) for v in discriminator_variables]))
+
+    # Average over the micro-batches, i.e. the mean over the whole batch.
+    losses = [loss / self.accum_steps for loss in losses]
+    generator_gradients = [g / self.accum_steps for g in generator_gradients]
+    discriminator_gradients = [g / self.accum_steps for g in discriminator_gradients]
+    return losses, generator_gradients, discriminator_gradients
+
+  def train_step(self, data):
+    # The batches arrive as uint8 and are converted on the device.
+    real_x, real_y = to_float(data[0]), to_float(data[1])
+    losses, generator_gradients, discriminator_gradients = self.compute_gradients(real_x, real_y)
+
+    num_g = len(self.generator_g.trainable_variables)
+    num_x = len(self.discriminator_x.trainable_variables)
 
     # Apply the gradients to the optimizer
-    self.generator_g_optimizer.apply_gradients(zip(generator_g_gradients,
+    self.generator_g_optimizer.apply_gradients(zip(generator_gradients[:num_g],
                                               self.generator_g.trainable_variables))
 
-    self.generator_f_optimizer.apply_gradients(zip(generator_f_gradients,
+    self.generator_f_optimizer.apply_gradients(zip(generator_gradients[num_g:],
                                               self.generator_f.trainable_variables))
 
-    self.discriminator_x_optimizer.apply_gradients(zip(discriminator_x_gradients,
+    self.discriminator_x_optimizer.apply_gradients(zip(discriminator_gradients[:num_x],
                                                   self.discriminator_x.trainable_variables))
 
-    self.discriminator_y_optimizer.apply_gradients(zip(discriminator_y_gradients,
+    self.discriminator_y_optimizer.apply_gradients(zip(discriminator_gradients[num_x:],
                                                   self.discriminator_y.trainable_variables))
 
-    return disc_x_loss, total_gen_g_loss
+    # The losses are divided by the global batch size. Scale them back to the mean over this replica.
+    disc_loss, gen_loss = losses
+    num_replicas = self.distribute_strategy.num_replicas_in_sync
+    self.disc_loss_tracker.update_state(disc_loss * num_replicas)
+    self.gen_loss_tracker.update_state(gen_loss * num_replicas)
 
-  def train(self, train_img, train_tar, epochs):
-    gen_loss_list = []
-    disc_loss_list = []
-    epoch_list = []
+    return {'disc_loss': self.disc_loss_tracker.result(), 'gen_loss': self.gen_loss_tracker.result()}
 
-    for epoch in range(epochs):
-      start = time.time()
+  def train(self, dataset, epochs):
+    """Trains on a dataset of batched (original, target) pairs, as returned by load_and_preprocessing_data."""
+    # Using a consistent image so that the progress of the model
+    # is clearly visible.
+    sample_img = to_float(next(iter(dataset))[0])
 
-      n = 0
-      for image_x, image_y in tf.data.Dataset.zip((train_img, train_tar)):
-        disc_loss, gen_loss = self.train_step(image_x, image_y)
-        print('{}th epoch {}th batch >>> Disc loss: {} , Gen loss: {}'.format(epoch+1, n+1, disc_loss, gen_loss))
+    start = time.time()
 
-        # if n % 10 == 0:
-        #   print ('.', end='')
-        n += 1
+    def on_epoch_begin(epoch, logs):
+      nonlocal start
+      start = time.time()
 
+    def on_epoch_end(epoch, logs):
       clear_output(wait=True)
-      # Using a consistent image so that the progress of the model
-      # is clearly visible.
-
-      sample_img = next(iter(train_img))
-      sample_tar = next(iter(train_tar))
-      self.generate_images(self.generator_g, sample_img)
-
-      # if (epoch + 1) % 5 == 0:
-      #   ckpt_save_path = ckpt_manager.save()
-      #   print ('Saving checkpoint for epoch {} at {}'.format(epoch+1,
-      #                                                       ckpt_save_path))
+      # pyplot is not thread-safe, so the sample images are drawn here, on the thread running fit,
+      # and only every sample_every epochs.
+      if (epoch + 1) % self.sample_every == 0:
+        self.generate_images(self.generator_g, sample_img)
 
       print ('Time taken for epoch {} is {} sec\n'.format(epoch + 1,
                                                           time.time()-start))
 
-      print('Disc loss: {} , Gen loss: {}'.format(disc_loss, gen_loss))
+      print('Disc loss: {} , Gen loss: {}'.format(logs['disc_loss'], logs['gen_loss']))
 
-      epoch_list.append(epoch+1)
-      gen_loss_list.append(gen_loss)
-      disc_loss_list.append(disc_loss)
+    # fit runs the compiled train_step and prefetches the next batches to the devices meanwhile.
+    history = self.fit(
+        dataset,
+        epochs=epochs,
+        callbacks=[tf.keras.callbacks.LambdaCallback(on_epoch_begin=on_epoch_begin, on_epoch_end=on_epoch_end)])
 
-    return np.array([epoch_list, gen_loss_list, disc_loss_list])
+    epoch_list = [epoch+1 for epoch in history.epoch]
+    return np.array([epoch_list, history.history['gen_loss'], history.history['disc_loss']])
 
 class InstanceNormalization(tf.keras.layers.Layer):
   """Instance Normalization Layer (https://arxiv.org/abs/1607.08022)."""
 
-  def __init__(self, epsilon=1e-5):
+  def __init__(self, epsilon=1e-5, data_format='channels_last'):
     super(InstanceNormalization, self).__init__()
     self.epsilon = epsilon
+    self.data_format = data_format
+    self.channel_axis = 1 if data_format == 'channels_first' else -1
 
   def build(self, input_shape):
     self.scale = self.add_weight(
         name='scale',
-        shape=input_shape[-1:],
+        shape=(input_shape[self.channel_axis],),
         initializer=tf.random_normal_initializer(1., 0.02),
         trainable=True)
 
     self.offset = self.add_weight(
         name='offset',
-        shape=input_shape[-1:],
+        shape=(input_shape[self.channel_axis],),
         initializer='zeros',
         trainable=True)
 
   def call(self, x):
-    mean, variance = tf.nn.moments(x, axes=[1, 2], keepdims=True)
-    inv = tf.math.rsqrt(variance + self.epsilon)
-    normalized = (x - mean) * inv
-    return self.scale * normalized + self.offset
+    # Fold the batch into the channels so that the batch statistics of a single
+    # fused batch norm kernel are the statistics of each instance and channel.
+    # The fused kernel takes float32 scale and offset also for float16 inputs.
+    shape = tf.shape(x)
+    n, c = shape[0], x.shape[self.channel_axis]
+    scale = tf.tile(tf.cast(self.scale, tf.float32), [n])
+    offset = tf.tile(tf.cast(self.offset, tf.float32), [n])
+
+    if self.data_format == 'channels_first':
+      # (N, C, H, W) -> (1, N*C, H, W) is a plain reshape.
+      h, w = shape[2], shape[3]
+      y = tf.reshape(x, (1, n*c, h, w))
+      y, _, _ = tf.compat.v1.nn.fused_batch_norm(y, scale, offset, epsilon=self.epsilon, data_format='NCHW', is_training=True)
+      return tf.reshape(y, (n, c, h, w))
+
+    # (N, H, W, C) -> (1, H, W, N*C)
+    h, w = shape[1], shape[2]
+    y = tf.reshape(tf.transpose(x, (1, 2, 0, 3)), (1, h, w, n*c))
+    y, _, _ = tf.compat.v1.nn.fused_batch_norm(y, scale, offset, epsilon=self.epsilon, is_training=True)
+    return tf.transpose(tf.reshape(y, (h, w, n, c)), (2, 0, 1, 3))
+
+
+def default_data_format():
+  """Returns 'channels_first' when a GPU is available and 'channels_last' otherwise.
+  cuDNN runs its fastest convolutions in NCHW, while the CPU kernels only support NHWC.
+  """
+  if tf.config.list_logical_devices('GPU'):
+    return 'channels_first'
+  return 'channels_last'
+
+
+def normalization(norm_type, data_format='channels_last'):
+  """Returns the normalization layer of norm_type; either 'batchnorm' or 'instancenorm', otherwise None."""
+  if norm_type.lower() == 'batchnorm':
+    return tf.keras.layers.BatchNormalization(axis=1 if data_format == 'channels_first' else -1)
+  elif norm_type.lower() == 'instancenorm':
+    return InstanceNormalization(data_format=data_format)
+  return None
+
+
+class DownBlock(tf.keras.layers.Layer):
+  """Conv2D => Batchnorm => LeakyRelu as a single layer.
+
+  The convolution runs directly on its own kernel with tf.nn.conv2d, so each block is
+  one layer call instead of a Sequential model with three sub-layers.
+  """
+
+  def __init__(self, filters, size, norm_type='batchnorm', apply_norm=True, data_format='channels_last'):
+    super(DownBlock, self).__init__()
+    self.filters = filters
+    self.size = size
+    self.data_format = 'NCHW' if data_format == 'channels_first' else 'NHWC'
+    self.channel_axis = 1 if data_format == 'channels_first' else -1
+
+    self.norm = normalization(norm_type, data_format) if apply_norm else None
+
+  def build(self, input_shape):
+    self.kernel = self.add_weight(
+        name='kernel',
+        shape=(self.size, self.size, input_shape[self.channel_axis], self.filters),
+        initializer=tf.random_normal_initializer(0., 0.02),
+        trainable=True)
+
+  def call(self, x, training=None):
+    x = tf.nn.conv2d(x, self.kernel, strides=2, padding='SAME', data_format=self.data_format)
+    if self.norm is not None:
+      x = self.norm(x, training=training)
+    # Same slope as tf.keras.layers.LeakyReLU()
+    return tf.nn.leaky_relu(x, alpha=0.3)
+
+
+class UpBlock(tf.keras.layers.Layer):
+  """Conv2DTranspose => Batchnorm => Dropout => Relu as a single layer.
+
+  The transposed convolution runs directly on its own kernel with tf.nn.conv2d_transpose.
+  """
 
+  def __init__(self, filters, size, norm_type='batchnorm', apply_dropout=False, data_format='channels_last'):
+    super(UpBlock, self).__init__()
+    self.filters = filters
+    self.size = size
+    self.data_format = 'NCHW' if data_format == 'channels_first' else 'NHWC'
+    self.channel_axis = 1 if data_format == 'channels_first' else -1
 
-def downsample(filters, size, norm_type='batchnorm', apply_norm=True):
+    self.norm = normalization(norm_type, data_format)
+
+    self.dropout = tf.keras.layers.Dropout(0.5) if apply_dropout else None
+
+  def build(self, input_shape):
+    # The kernel of a transposed convolution has the shape (height, width, output channels, input channels).
+    self.kernel = self.add_weight(
+        name='kernel',
+        shape=(self.size, self.size, self.filters, input_shape[self.channel_axis]),
+        initializer=tf.random_normal_initializer(0., 0.02),
+        trainable=True)
+
+  def call(self, x, training=None):
+    # Static dims where known, so that the output keeps its static H and W; tf.shape only for the unknown ones.
+    shape = [dim if dim is not None else tf.shape(x)[i] for i, dim in enumerate(x.shape)]
+    if self.data_format == 'NCHW':
+      output_shape = tf.stack([shape[0], self.filters, shape[2]*2, shape[3]*2])
+    else:
+      output_shape = tf.stack([shape[0], shape[1]*2, shape[2]*2, self.filters])
+    x = tf.nn.conv2d_transpose(x, self.kernel, output_shape, strides=2, padding='SAME', data_format=self.data_format)
+    if self.norm is not None:
+      x = self.norm(x, training=training)
+    if self.dropout is not None:
+      x = self.dropout(x, training=training)
+    return tf.nn.relu(x)
+
+
+def downsample(filters, size, norm_type='batchnorm', apply_norm=True, data_format='channels_last'):
   """Downsamples an input.
 
   Conv2D => Batchnorm => LeakyRelu
@@ -299,29 +702,15 @@ def downsample(filters, size, norm_type='batchnorm', apply_norm=True):
     size: filter size
     norm_type: Normalization type; either 'batchnorm' or 'instancenorm'.
     apply_norm: If True, adds the batchnorm layer
+    data_format: Either 'channels_last' or 'channels_first'.
 
   Returns:
-    Downsample Sequential Model
+    Downsample layer
   """
-  initializer = tf.random_normal_initializer(0., 0.02)
-
-  result = tf.keras.Sequential()
-  result.add(
-      tf.keras.layers.Conv2D(filters, size, strides=2, padding='same',
-                             kernel_initializer=initializer, use_bias=False))
-
-  if apply_norm:
-    if norm_type.lower() == 'batchnorm':
-      result.add(tf.keras.layers.BatchNormalization())
-    elif norm_type.lower() == 'instancenorm':
-      result.add(InstanceNormalization())
-
-  result.add(tf.keras.layers.LeakyReLU())
+  return DownBlock(filters, size, norm_type, apply_norm, data_format)
 
-  return result
 
-
-def upsample(filters, size, norm_type='batchnorm', apply_dropout=False):
+def upsample(filters, size, norm_type='batchnorm', apply_dropout=False, data_format='channels_last'):
   """Upsamples an input.
 
   Conv2DTranspose => Batchnorm => Dropout => Relu
@@ -331,75 +720,66 @@ def upsample(filters, size, norm_type='batchnorm', apply_dropout=False):
     size: filter size
     norm_type: Normalization type; either 'batchnorm' or 'instancenorm'.
     apply_dropout: If True, adds the dropout layer
+    data_format: Either 'channels_last' or 'channels_first'.
 
   Returns:
-    Upsample Sequential Model
+    Upsample layer
   """
+  return UpBlock(filters, size, norm_type, apply_dropout, data_format)
 
-  initializer = tf.random_normal_initializer(0., 0.02)
-
-  result = tf.keras.Sequential()
-  result.add(
-      tf.keras.layers.Conv2DTranspose(filters, size, strides=2,
-                                      padding='same',
-                                      kernel_initializer=initializer,
-                                      use_bias=False))
-
-  if norm_type.lower() == 'batchnorm':
-    result.add(tf.keras.layers.BatchNormalization())
-  elif norm_type.lower() == 'instancenorm':
-    result.add(InstanceNormalization())
-
-  if apply_dropout:
-    result.add(tf.keras.layers.Dropout(0.5))
-
-  result.add(tf.keras.layers.ReLU())
-
-  return result
-
-def unet_generator(output_channels, norm_type='batchnorm'):
+def unet_generator(output_channels, norm_type='batchnorm', data_format=None, image_size=None):
   """Modified u-net generator model (https://arxiv.org/abs/1611.07004).
 
   Args:
     output_channels: Output channels
     norm_type: Type of normalization. Either 'batchnorm' or 'instancenorm'.
+    data_format: Layout of the layers inside the model; either 'channels_last' or 'channels_first'.
+      Defaults to default_data_format(). Inputs and outputs are channels last either way.
+    image_size: Tuple (height, width) of the training images. Fixing it gives every layer static shapes,
+      so the compiled train step is traced once. If None, the model takes any image size.
 
   Returns:
     Generator model
   """
+  data_format = data_format or default_data_format()
 
   down_stack = [
-      downsample(64, 4, norm_type, apply_norm=False),  # (bs, 128, 128, 64)
-      downsample(128, 4, norm_type),  # (bs, 64, 64, 128)
-      downsample(256, 4, norm_type),  # (bs, 32, 32, 256)
-      downsample(512, 4, norm_type),  # (bs, 16, 16, 512)
-      downsample(512, 4, norm_type),  # (bs, 8, 8, 512)
-      downsample(512, 4, norm_type),  # (bs, 4, 4, 512)
-      downsample(512, 4, norm_type),  # (bs, 2, 2, 512)
-      downsample(512, 4, norm_type),  # (bs, 1, 1, 512)
+      downsample(64, 4, norm_type, apply_norm=False, data_format=data_format),  # (bs, 128, 128, 64)
+      downsample(128, 4, norm_type, data_format=data_format),  # (bs, 64, 64, 128)
+      downsample(256, 4, norm_type, data_format=data_format),  # (bs, 32, 32, 256)
+      downsample(512, 4, norm_type, data_format=data_format),  # (bs, 16, 16, 512)
+      downsample(512, 4, norm_type, data_format=data_format),  # (bs, 8, 8, 512)
+      downsample(512, 4, norm_type, data_format=data_format),  # (bs, 4, 4, 512)
+      downsample(512, 4, norm_type, data_format=data_format),  # (bs, 2, 2, 512)
+      downsample(512, 4, norm_type, data_format=data_format),  # (bs, 1, 1, 512)
   ]
 
   up_stack = [
-      upsample(512, 4, norm_type, apply_dropout=True),  # (bs, 2, 2, 1024)
-      upsample(512, 4, norm_type, apply_dropout=True),  # (bs, 4, 4, 1024)
-      upsample(512, 4, norm_type, apply_dropout=True),  # (bs, 8, 8, 1024)
-      upsample(512, 4, norm_type),  # (bs, 16, 16, 1024)
-      upsample(256, 4, norm_type),  # (bs, 32, 32, 512)
-      upsample(128, 4, norm_type),  # (bs, 64, 64, 256)
-      upsample(64, 4, norm_type),  # (bs, 128, 128, 128)
+      upsample(512, 4, norm_type, apply_dropout=True, data_format=data_format),  # (bs, 2, 2, 1024)
+      upsample(512, 4, norm_type, apply_dropout=True, data_format=data_format),  # (bs, 4, 4, 1024)
+      upsample(512, 4, norm_type, apply_dropout=True, data_format=data_format),  # (bs, 8, 8, 1024)
+      upsample(512, 4, norm_type, data_format=data_format),  # (bs, 16, 16, 1024)
+      upsample(256, 4, norm_type, data_format=data_format),  # (bs, 32, 32, 512)
+      upsample(128, 4, norm_type, data_format=data_format),  # (bs, 64, 64, 256)
+      upsample(64, 4, norm_type, data_format=data_format),  # (bs, 128, 128, 128)
   ]
 
   initializer = tf.random_normal_initializer(0., 0.02)
+  # Keep the output in float32 under mixed precision
   last = tf.keras.layers.Conv2DTranspose(
       output_channels, 4, strides=2,
-      padding='same', kernel_initializer=initializer,
-      activation='tanh')  # (bs, 256, 256, 3)
+      padding='same', kernel_initializer=initializer, data_format=data_format,
+      activation='tanh', dtype='float32')  # (bs, 256, 256, 3)
 
-  concat = tf.keras.layers.Concatenate()
+  concat = tf.keras.layers.Concatenate(axis=1 if data_format == 'channels_first' else -1)
 
-  inputs = tf.keras.layers.Input(shape=[None, None, 3])
+  inputs = tf.keras.layers.Input(shape=[*(image_size or (None, None)), 3])
   x = inputs
 
+  # Transpose once at the input; all layers below run channels first.
+  if data_format == 'channels_first':
+    x = tf.keras.layers.Permute((3, 1, 2))(x)
+
   # Downsampling through the model
   skips = []
   for down in down_stack:
@@ -415,9 +795,12 @@ def unet_generator(output_channels, norm_type='batchnorm'):
 
   x = last(x)
 
+  if data_format == 'channels_first':
+    x = tf.keras.layers.Permute((2, 3, 1), dtype='float32')(x)
+
   return tf.keras.Model(inputs=inputs, outputs=x)
 
-def resunet_generator(output_channels, norm_type='batchnorm', resnet=None, depth=3):
+def resunet_generator(output_channels, norm_type='batchnorm', resnet=None, depth=3, data_format=None, image_size=None):
   """Modified u-net generator model (https://arxiv.org/abs/1611.07004).
 
   Args:
@@ -425,45 +808,55 @@ def resunet_generator(output_channels, norm_type='batchnorm', resnet=None, depth
     norm_type: Type of normalization. Either 'batchnorm' or 'instancenorm'.
     resnet: Whether to apply SeResNet. Either None, 'SeResNet', or 'ResNet'.
     depth: Number of ResNet blocks for generator.
+    data_format: Layout of the layers inside the model; either 'channels_last' or 'channels_first'.
+      Defaults to default_data_format(). Inputs and outputs are channels last either way.
+    image_size: Tuple (height, width) of the training images. Fixing it gives every layer static shapes,
+      so the compiled train step is traced once. If None, the model takes any image size.
 
   Returns:
     Generator model
   """
+  data_format = data_format or default_data_format()
 
   down_stack = [
-      downsample(64, 4, norm_type, apply_norm=False),  # (bs, 128, 128, 64)
-      downsample(128, 4, norm_type),  # (bs, 64, 64, 128)
-      downsample(256, 4, norm_type),  # (bs, 32, 32, 256)
-      downsample(512, 4, norm_type),  # (bs, 16, 16, 512)
-      downsample(512, 4, norm_type),  # (bs, 8, 8, 512)
-      downsample(512, 4, norm_type),  # (bs, 4, 4, 512)
-      downsample(512, 4, norm_type),  # (bs, 2, 2, 512)
-      downsample(512, 4, norm_type),  # (bs, 1, 1, 512)
+      downsample(64, 4, norm_type, apply_norm=False, data_format=data_format),  # (bs, 128, 128, 64)
+      downsample(128, 4, norm_type, data_format=data_format),  # (bs, 64, 64, 128)
+      downsample(256, 4, norm_type, data_format=data_format),  # (bs, 32, 32, 256)
+      downsample(512, 4, norm_type, data_format=data_format),  # (bs, 16, 16, 512)
+      downsample(512, 4, norm_type, data_format=data_format),  # (bs, 8, 8, 512)
+      downsample(512, 4, norm_type, data_format=data_format),  # (bs, 4, 4, 512)
+      downsample(512, 4, norm_type, data_format=data_format),  # (bs, 2, 2, 512)
+      downsample(512, 4, norm_type, data_format=data_format),  # (bs, 1, 1, 512)
   ]
 
   res_block = ResNet_Blocks(512, resnet, depth) # (bs, 1, 1, 512)
 
   up_stack = [
-      upsample(512, 4, norm_type, apply_dropout=True),  # (bs, 2, 2, 1024)
-      upsample(512, 4, norm_type, apply_dropout=True),  # (bs, 4, 4, 1024)
-      upsample(512, 4, norm_type, apply_dropout=True),  # (bs, 8, 8, 1024)
-      upsample(512, 4, norm_type),  # (bs, 16, 16, 1024)
-      upsample(256, 4, norm_type),  # (bs, 32, 32, 512)
-      upsample(128, 4, norm_type),  # (bs, 64, 64, 256)
-      upsample(64, 4, norm_type),  # (bs, 128, 128, 128)
+      upsample(512, 4, norm_type, apply_dropout=True, data_format=data_format),  # (bs, 2, 2, 1024)
+      upsample(512, 4, norm_type, apply_dropout=True, data_format=data_format),  # (bs, 4, 4, 1024)
+      upsample(512, 4, norm_type, apply_dropout=True, data_format=data_format),  # (bs, 8, 8, 1024)
+      upsample(512, 4, norm_type, data_format=data_format),  # (bs, 16, 16, 1024)
+      upsample(256, 4, norm_type, data_format=data_format),  # (bs, 32, 32, 512)
+      upsample(128, 4, norm_type, data_format=data_format),  # (bs, 64, 64, 256)
+      upsample(64, 4, norm_type, data_format=data_format),  # (bs, 128, 128, 128)
   ]
 
   initializer = tf.random_normal_initializer(0., 0.02)
+  # Keep the output in float32 under mixed precision
   last = tf.keras.layers.Conv2DTranspose(
       output_channels, 4, strides=2,
-      padding='same', kernel_initializer=initializer,
-      activation='tanh')  # (bs, 256, 256, 3)
+      padding='same', kernel_initializer=initializer, data_format=data_format,
+      activation='tanh', dtype='float32')  # (bs, 256, 256, 3)
 
-  concat = tf.keras.layers.Concatenate()
+  concat = tf.keras.layers.Concatenate(axis=1 if data_format == 'channels_first' else -1)
 
-  inputs = tf.keras.layers.Input(shape=[None, None, 3])
+  inputs = tf.keras.layers.Input(shape=[*(image_size or (None, None)), 3])
   x = inputs
 
+  # Transpose once at the input; all layers below run channels first.
+  if data_format == 'channels_first':
+    x = tf.keras.layers.Permute((3, 1, 2))(x)
+
   # Downsampling through the model
   skips = []
   for down in down_stack:
@@ -473,7 +866,13 @@ def resunet_generator(output_channels, norm_type='batchnorm', resnet=None, depth
   skips = reversed(skips[:-1])
 
   # ResNet Blocks
-  x = res_block(x)
+  # The ResNet blocks are channels last. The bottleneck is small, so the transposes around them are cheap.
+  if data_format == 'channels_first':
+    x = tf.keras.layers.Permute((2, 3, 1))(x)
+    x = res_block(x)
+    x = tf.keras.layers.Permute((3, 1, 2))(x)
+  else:
+    x = res_block(x)
 
   # Upsampling and establishing the skip connections
   for up, skip in zip(up_stack, skips):
@@ -482,50 +881,63 @@ def resunet_generator(output_channels, norm_type='batchnorm', resnet=None, depth
 
   x = last(x)
 
+  if data_format == 'channels_first':
+    x = tf.keras.layers.Permute((2, 3, 1), dtype='float32')(x)
+
   return tf.keras.Model(inputs=inputs, outputs=x)
 
 
-def discriminator(norm_type='batchnorm', target=True):
+def discriminator(norm_type='batchnorm', target=True, data_format=None, image_size=None):
   """PatchGan discriminator model (https://arxiv.org/abs/1611.07004).
 
   Args:
     norm_type: Type of normalization. Either 'batchnorm' or 'instancenorm'.
     target: Bool, indicating whether target image is an input or not.
+    data_format: Layout of the layers inside the model; either 'channels_last' or 'channels_first'.
+      Defaults to default_data_format(). Inputs and outputs are channels last either way.
+    image_size: Tuple (height, width) of the training images. Fixing it gives every layer static shapes,
+      so the compiled train step is traced once. If None, the model takes any image size.
 
   Returns:
     Discriminator model
   """
+  data_format = data_format or default_data_format()
 
   initializer = tf.random_normal_initializer(0., 0.02)
 
-  inp = tf.keras.layers.Input(shape=[None, None, 3], name='input_image')
+  inp = tf.keras.layers.Input(shape=[*(image_size or (None, None)), 3], name='input_image')
   x = inp
 
   if target:
-    tar = tf.keras.layers.Input(shape=[None, None, 3], name='target_image')
+    tar = tf.keras.layers.Input(shape=[*(image_size or (None, None)), 3], name='target_image')
     x = tf.keras.layers.concatenate([inp, tar])  # (bs, 256, 256, channels*2)
 
-  down1 = downsample(64, 4, norm_type, False)(x)  # (bs, 128, 128, 64)
-  down2 = downsample(128, 4, norm_type)(down1)  # (bs, 64, 64, 128)
-  down3 = downsample(256, 4, norm_type)(down2)  # (bs, 32, 32, 256)
+  # Transpose once at the input; all layers below run channels first.
+  if data_format == 'channels_first':
+    x = tf.keras.layers.Permute((3, 1, 2))(x)
+
+  down1 = downsample(64, 4, norm_type, False, data_format)(x)  # (bs, 128, 128, 64)
+  down2 = downsample(128, 4, norm_type, data_format=data_format)(down1)  # (bs, 64, 64, 128)
+  down3 = downsample(256, 4, norm_type, data_format=data_format)(down2)  # (bs, 32, 32, 256)
 
-  zero_pad1 = tf.keras.layers.ZeroPadding2D()(down3)  # (bs, 34, 34, 256)
+  zero_pad1 = tf.keras.layers.ZeroPadding2D(data_format=data_format)(down3)  # (bs, 34, 34, 256)
   conv = tf.keras.layers.Conv2D(
       512, 4, strides=1, kernel_initializer=initializer,
-      use_bias=False)(zero_pad1)  # (bs, 31, 31, 512)
+      use_bias=False, data_format=data_format)(zero_pad1)  # (bs, 31, 31, 512)
 
-  if norm_type.lower() == 'batchnorm':
-    norm1 = tf.keras.layers.BatchNormalization()(conv)
-  elif norm_type.lower() == 'instancenorm':
-    norm1 = InstanceNormalization()(conv)
+  norm1 = normalization(norm_type, data_format)(conv)
 
   leaky_relu = tf.keras.layers.LeakyReLU()(norm1)
 
-  zero_pad2 = tf.keras.layers.ZeroPadding2D()(leaky_relu)  # (bs, 33, 33, 512)
+  zero_pad2 = tf.keras.layers.ZeroPadding2D(data_format=data_format)(leaky_relu)  # (bs, 33, 33, 512)
 
+  # Keep the logits in float32 under mixed precision
   last = tf.keras.layers.Conv2D(
-      1, 4, strides=1,
-      kernel_initializer=initializer)(zero_pad2)  # (bs, 30, 30, 1)
+      1, 4, strides=1, data_format=data_format,
+      kernel_initializer=initializer, dtype='float32')(zero_pad2)  # (bs, 30, 30, 1)
+
+  if data_format == 'channels_first':
+    last = tf.keras.layers.Permute((2, 3, 1), dtype='float32')(last)
 
   if target:
     return tf.keras.Model(inputs=[inp, tar], outputs=last)
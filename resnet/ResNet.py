@@ -1,6 +1,132 @@
+import os
+import collections
+import functools
+import itertools
+
+import numpy as np
 import tensorflow as tf
 from tensorflow.keras import layers
 
+# Mixed precision is opt-in: call utilities.precision.set_mixed_precision_policy() before building the models.
+# The layers then compute in float16/bfloat16 while the variables stay in float32.
+# The output layers of the models are kept in float32 for the loss computation.
+
+# Activation layer classes by lower case name
+ACTIVATIONS = {
+    'leakyrelu': layers.LeakyReLU,
+    'relu': layers.ReLU,
+}
+
+def activation_class(activation, default=layers.ReLU):
+  '''Returns the activation layer class for the name of activation, which is case insensitive.
+  Other names give default. None or '' gives None.
+  '''
+  if not activation:
+    return None
+  return ACTIVATIONS.get(activation.lower(), default)
+
+def apply_layers(block, x, training=None):
+  '''Applies the layers of block to x in order, as one straight chain of calls.'''
+  return functools.reduce(lambda x, layer: layer(x, training=training), block, x)
+
+Shapes = collections.namedtuple('Shapes', ['project_size', 'project_shape', 'dense_units', 'input_shape'])
+
+@functools.lru_cache(maxsize=32)
+def derive_shapes(image_size, num_filters, channels=None):
+  '''Returns the Shapes derived from the image size as tuples, memoized for repeated model builds.
+  arguments:
+    image_size: Tuple. Image size with the sphape of (height, width).
+    num_filters: Int. Number of filters of the projected feature map.
+    channels: Int. Number of channels of images. input_shape is None if None.
+  '''
+  # Project size; 4 times upsampling by 2 gives the image size
+  project_size = tuple(x//16 for x in image_size)
+  return Shapes(
+      project_size=project_size,
+      project_shape=project_size + (num_filters,),
+      dense_units=project_size[0] * project_size[1] * num_filters,
+      input_shape=tuple(image_size) + (channels,) if channels else None)
+
+class Projection(layers.Layer):
+  '''Dense projection without bias for the latent vectors, with a selectable matmul dtype.
+  The kernel is kept in float32 for the optimizer and cast to matmul_dtype per call. By default this is the
+  compute dtype of the global policy, so under mixed_bfloat16 the large latent projection runs on the bfloat16
+  Tensor Cores with half the weight bandwidth, and under the default float32 policy it stays in float32.
+
+  arguments:
+    units: Int. Number of output units.
+    matmul_dtype: Str. dtype of the matmul, e.g. 'bfloat16'. If None, the compute dtype of the layer.
+  '''
+  def __init__(self, units, matmul_dtype=None, **kwargs):
+    super(Projection, self).__init__(**kwargs)
+    self.units = units
+    self.matmul_dtype = matmul_dtype
+
+  def build(self, input_shape):
+    self.kernel = self.add_weight(
+        name='kernel',
+        shape=(input_shape[-1], self.units),
+        initializer='glorot_uniform',
+        dtype=tf.float32,
+        trainable=True,
+        experimental_autocast=False)
+
+  def call(self, z):
+    dtype = self.matmul_dtype or self.compute_dtype
+    x = tf.linalg.matmul(tf.cast(z, dtype), tf.cast(self.kernel, dtype))
+    return tf.cast(x, self.compute_dtype)
+
+class SubPixelConv2D(layers.Layer):
+  '''Upsamples by scale with a Conv2D to scale**2 times the filters followed by depth_to_space (sub-pixel convolution).
+  The output has the shape of Conv2DTranspose(filters, kernel_size, strides=scale, padding='same'), but it runs as an ordinary
+  stride 1 conv, for which cuDNN can use Winograd kernels and needs no col2im workspace. It also avoids checkerboard artifacts.
+
+  arguments:
+    filters: Int. Number of output filters.
+    kernel_size: Tuple. Kernel size of the conv. (3, 3) covers the input pixels of a 4x4 stride 2 transposed conv.
+    scale: Int. Upsampling factor. The default is 2.
+    use_bias: Boolean, whether the conv uses a bias.
+    activation: Activation applied to the output.
+  '''
+  def __init__(self, filters, kernel_size=(3,3), scale=2, use_bias=False, activation=None, **kwargs):
+    super(SubPixelConv2D, self).__init__(**kwargs)
+    self.filters = filters
+    self.kernel_size = kernel_size
+    self.scale = scale
+    # The channel k*filters + c of the conv output becomes the sub-pixel k of the output channel c.
+    self.conv = layers.Conv2D(filters*scale**2, kernel_size, padding='same', use_bias=use_bias, dtype=kwargs.get('dtype'))
+    self.activation = tf.keras.activations.get(activation)
+
+  def build(self, input_shape):
+    self.conv.build(input_shape)
+    super(SubPixelConv2D, self).build(input_shape)
+
+  def call(self, x):
+    return self.activation(tf.nn.depth_to_space(self.conv(x), self.scale))
+
+  def get_config(self):
+    config = super(SubPixelConv2D, self).get_config()
+    config.update(
+        filters=self.filters,
+        kernel_size=self.kernel_size,
+        scale=self.scale,
+        use_bias=self.conv.use_bias,
+        activation=tf.keras.activations.serialize(self.activation),
+    )
+    return config
+
+def upsampling_layer(filters, kernel_size=(4,4), upsampling='subpixel', **kwargs):
+  '''Returns a layer upsampling by 2 to filters.
+  arguments:
+    filters: Int. Number of output filters.
+    kernel_size: Tuple. Kernel size of the transposed conv. The sub-pixel conv is always 3x3.
+    upsampling: Str. 'subpixel' for SubPixelConv2D, 'transpose' for Conv2DTranspose.
+    kwargs: use_bias, activation or dtype of the layer.
+  '''
+  if upsampling == 'transpose':
+    return layers.Conv2DTranspose(filters, kernel_size, strides=(2, 2), padding='same', **kwargs)
+  return SubPixelConv2D(filters, **kwargs)
+
 class Initial_Block(layers.Layer):
   def __init__(self,
           latent_dim = 100, # Dimension of random noise (latent space vectors)
@@ -11,15 +137,12 @@ class Initial_Block(layers.Layer):
           dense=True,
           ):
     super(Initial_Block, self).__init__()
-    # Project size
-    project_size = [x//16 for x in image_size]
-    # Project shape
-    project_shape = project_size + [num_filters]
-    dense_units = project_size[0] * project_size[1] * num_filters
+    # Project size, project shape and dense units
+    project_size, project_shape, dense_units, _ = derive_shapes(tuple(image_size), num_filters)
 
     if dense:
       self.block=[
-          layers.Dense(dense_units, use_bias=False, input_dim=latent_dim)
+          Projection(dense_units, input_dim=latent_dim)
       ]
     else:
       self.block=[
@@ -27,44 +150,35 @@ class Initial_Block(layers.Layer):
           layers.Conv2DTranspose(num_filters, project_size, strides=(1, 1), padding='valid', use_bias=False),
       ]
 
-    self.block.append(layers.BatchNormalization())
+    # The fused kernel needs 4D input, which the output of the projection is not.
+    self.block.append(layers.BatchNormalization(fused=not dense, momentum=0.9, epsilon=1e-5))
 
-    if not activation:
-      pass
-    elif 'leakyrelu' == activation.lower():
-      self.block.append(layers.LeakyReLU())
-    else:
-      self.block.append(layers.ReLU())
+    act_cls = activation_class(activation)
+    if act_cls:
+      self.block.append(act_cls())
 
     self.block.append(layers.Reshape(project_shape))
 
-  def call(self, x):
-    for layer in self.block:
-      x = layer(x)
-    return x
+  def call(self, x, training=None):
+    return apply_layers(self.block, x, training)
 
 class TransConv_Block(layers.Layer):
-  def __init__(self, num_filters=1024, kernel_size=(4,4), activation='LeakyReLU', batchnorm=True):
-    super(TransConv_Block, self).__init__()
-    # Transposed Conv block
-    self.block =[tf.keras.layers.Conv2DTranspose(num_filters, kernel_size, strides=(2, 2), padding='same', use_bias=False)]
+  def __init__(self, num_filters=1024, kernel_size=(4,4), activation='LeakyReLU', batchnorm=True, dtype=None, upsampling='subpixel'):
+    # dtype: dtype policy of the block, e.g. 'float32' for the output block under mixed precision.
+    # upsampling: 'subpixel' or 'transpose', see upsampling_layer.
+    super(TransConv_Block, self).__init__(dtype=dtype)
+    # Upsampling conv block
+    self.block =[upsampling_layer(num_filters, kernel_size, upsampling, use_bias=False, dtype=dtype)]
 
     if batchnorm:
-      self.block.append(tf.keras.layers.BatchNormalization())
+      self.block.append(tf.keras.layers.BatchNormalization(fused=True, momentum=0.9, epsilon=1e-5, dtype=dtype))
     
-    if not activation:
-      pass
-    elif 'leakyrelu' == activation.lower():
-      self.block.append(layers.LeakyReLU())
-    elif 'relu' == activation.lower():
-      self.block.append(layers.Activation('relu'))
-    elif 'tanh':
-      self.block.append(layers.Activation('tanh'))
+    act_cls = activation_class(activation, default=functools.partial(layers.Activation, 'tanh'))
+    if act_cls:
+      self.block.append(act_cls(dtype=dtype))
 
-  def call(self, x):
-    for layer in self.block:
-      x = layer(x)
-    return x
+  def call(self, x, training=None):
+    return apply_layers(self.block, x, training)
 
 class Conv_Block(layers.Layer):
   def __init__(self, num_filters, kernel_size, strides, pooling='max', batchnorm=False, dropout=False, dropout_rate=0.4):
@@ -79,156 +193,156 @@ class Conv_Block(layers.Layer):
       self.conv_block.append(tf.keras.layers.AveragePooling2D(pool_size=(2, 2)))
     # Batch Normalization
     if batchnorm:
-      self.conv_block.append(tf.keras.layers.BatchNormalization())
+      self.conv_block.append(tf.keras.layers.BatchNormalization(fused=True, momentum=0.9, epsilon=1e-5))
     # Leaky ReLU Activaton
     self.conv_block.append(tf.keras.layers.LeakyReLU())
     # Dropout
     if dropout:
       self.conv_block.append(tf.keras.layers.Dropout(dropout_rate))
 
-  def call(self, x):
-    for layer in self.conv_block:
-      x = layer(x)
-    return x
+  def call(self, x, training=None):
+    return apply_layers(self.conv_block, x, training)
 
 class Header_Block(layers.Layer):
   def __init__(self, dense=True, kernel_size=(4,4)):
     super(Header_Block, self).__init__()
 # Header block
+    # The logits are kept in float32 under mixed precision.
     if dense:
-      self.block = [tf.keras.layers.Flatten(), tf.keras.layers.Dense(1)]
+      self.block = [tf.keras.layers.Flatten(), tf.keras.layers.Dense(1, dtype='float32')]
     else:
-      self.block = [tf.keras.layers.Conv2D(1, kernel_size, strides=(2, 2), padding='valid'), tf.keras.layers.GlobalAveragePooling2D()]
+      self.block = [tf.keras.layers.Conv2D(1, kernel_size, strides=(2, 2), padding='valid', dtype='float32'), tf.keras.layers.GlobalAveragePooling2D(dtype='float32')]
 
-  def call(self, x):
-    for layer in self.block:
-      x = layer(x)
-    return x
+  def call(self, x, training=None):
+    return apply_layers(self.block, x, training)
 
 class ResNet_Block(layers.Layer):
-  def __init__(self, filter_size=16, kernel_size=(3,3), strides=(1,1)):
+  def __init__(self, filter_size=16, kernel_size=(3,3), strides=(1,1), se=False, folded=False):
     ''' args:
          filter_size: numbers of output filters.
          kernel_size: kernel_size. default is (3,3)
          strides: turple. If this is not (1,1), skip connection are replaced to convolution layer and it makes an output downsized.
+         se: Boolean, whether to apply a SE block to the residual before the skip connection.
+         folded: Boolean, whether norm2 is folded into conv1. Made by folded_copy for inference.
     '''
     super(ResNet_Block, self).__init__()
 
-    self.norm1 = layers.BatchNormalization()
-    self.act1 = layers.Activation(tf.nn.relu)
+    self.filter_size = filter_size
+    self.kernel_size = kernel_size
+    self.strides = strides
+
+    self.norm1 = layers.BatchNormalization(fused=True, momentum=0.9, epsilon=1e-5)
     self.conv1 = layers.Conv2D(filter_size, kernel_size, strides=strides, padding='same')
 
+    # The skip connection is the input itself when the output is not downsized.
     if strides == (1,1):
-      self.shortcutblock = [layers.Identity()]
+      self.shortcutblock = None
     else:
       self.shortcutblock = [
-          layers.BatchNormalization(),
+          layers.BatchNormalization(fused=True, momentum=0.9, epsilon=1e-5),
           layers.Activation(tf.nn.relu),
           layers.Conv2D(filter_size, (1,1), strides=strides, padding='same')
        ]
 
-    self.norm2 = layers.BatchNormalization()
-    self.act2 = layers.Activation(tf.nn.relu)
+    self.norm2 = None if folded else layers.BatchNormalization(fused=True, momentum=0.9, epsilon=1e-5)
     self.conv2 = layers.Conv2D(filter_size, kernel_size, strides=(1,1), padding='same')
 
-    self.add = layers.Add()
+    self.seblock = SE_Block(filter_size) if se else None
 
-  def call(self, input):
+  # XLA fuses the BN -> ReLU -> Conv chains and the skip add into fewer kernels.
+  # training is an argument so that the function is traced separately for training and inference.
+  @tf.function(jit_compile=True, reduce_retracing=True)
+  def call(self, input, training=None):
     # Residual Block
-    x = self.norm1(input, training=False)
-    x = self.act1(x)
-    x = self.conv1(x)
+    x = self.conv1(tf.nn.relu(self.norm1(input, training=False)))
+    return self.fused_residual(x, input, training=training)
 
-    x = self.norm2(x, training=False)
-    x = self.act2(x)
-    x = self.conv2(x)
+  @tf.function(jit_compile=True, reduce_retracing=True)
+  def fused_residual(self, x, input, training=None):
+    '''norm2 -> relu -> conv2 (-> SE block) -> skip add as one XLA cluster,
+    so the conv output is added to the skip connection before it is written back to memory.
+    '''
+    if self.norm2 is not None:
+      x = self.norm2(x, training=False)
+    x = self.conv2(tf.nn.relu(x))
+
+    # SE block
+    if self.seblock is not None:
+      x = self.seblock(x)
 
     # Skip Connection Block
     skip = input
-    for layer in self.shortcutblock:
-      skip = layer(skip)
+    if self.shortcutblock:
+      skip = apply_layers(self.shortcutblock, skip, training)
 
-    x = self.add([x, skip])
+    return x + skip
 
-    return x
+  def folded_copy(self):
+    '''Returns a copy of the trained block for inference with norm2 folded into conv1:
+      W' = W * gamma / sqrt(var + eps)
+      b' = beta + (b - mean) * gamma / sqrt(var + eps)
+    norm1 can not be folded, since a ReLU is between it and conv1.
+    '''
+    block = ResNet_Block(self.filter_size, self.kernel_size, self.strides, se=self.seblock is not None, folded=True)
+    # Build the sublayers with a dummy input of the same number of channels.
+    block(tf.zeros((1, 8, 8, self.conv1.kernel.shape[2])))
+
+    bn = self.norm2
+    gamma = bn.gamma.numpy() if bn.scale else 1.
+    beta = bn.beta.numpy() if bn.center else 0.
+    factor = gamma / np.sqrt(bn.moving_variance.numpy() + bn.epsilon)
+    bias = self.conv1.bias.numpy() if self.conv1.use_bias else 0.
+    # The kernel of Conv2D has the shape of (height, width, in_channels, out_channels).
+    block.conv1.set_weights([self.conv1.kernel.numpy() * factor, beta + (bias - bn.moving_mean.numpy()) * factor])
+
+    block.norm1.set_weights(self.norm1.get_weights())
+    block.conv2.set_weights(self.conv2.get_weights())
+    if self.seblock is not None:
+      block.seblock.set_weights(self.seblock.get_weights())
+    if self.shortcutblock:
+      for copy, layer in zip(block.shortcutblock, self.shortcutblock):
+        copy.set_weights(layer.get_weights())
+    return block
 
 
 class SE_Block(layers.Layer):
   def __init__(self, num_filters=16, ratio=16):
     ''' args:
-         num_filters: numbers of output filters.
-         kernel_size: kernel_size. default is (3,3)
-         strides: turple. If this is not (1,1), skip connection are replaced to convolution layer and it makes an output downsized.
+         num_filters: numbers of channels of the input, which is also the output.
+         ratio: reduction ratio. The excitation has num_filters//ratio hidden units. default is 16
     '''
     super(SE_Block, self).__init__()
 
     self.num_filters = num_filters
-
-    self.avepooling = layers.GlobalAveragePooling2D()
-    self.dens1 = layers.Dense(num_filters//ratio, activation='relu')
-    self.dens2 = layers.Dense(num_filters, activation='sigmoid')
-    self.reshape = layers.Reshape((1, 1, num_filters))
-    self.multiply = layers.Multiply()
-
-  def call(self, input):
-    x = self.avepooling(input)
-    x = self.dens1(x)
-    x = self.dens2(x)
-    x = self.reshape(x)
-    x = self.multiply([input, x])
-    return x
-
-class SEResNet_Block(layers.Layer):
+    self.ratio = ratio
+
+  def build(self, input_shape):
+    # The weights of the two excitation Dense layers, held directly so that call is a few plain ops.
+    self.w1 = self.add_weight(name='w1', shape=(self.num_filters, self.num_filters//self.ratio), initializer='glorot_uniform', trainable=True)
+    self.b1 = self.add_weight(name='b1', shape=(self.num_filters//self.ratio,), initializer='zeros', trainable=True)
+    self.w2 = self.add_weight(name='w2', shape=(self.num_filters//self.ratio, self.num_filters), initializer='glorot_uniform', trainable=True)
+    self.b2 = self.add_weight(name='b2', shape=(self.num_filters,), initializer='zeros', trainable=True)
+
+  # Squeeze and excitation compile into one XLA cluster with the broadcast multiply,
+  # so the activations are read once for the squeeze and once for the scaling.
+  @tf.function(jit_compile=True, reduce_retracing=True)
+  def call(self, input, training=None):
+    # Squeeze, keeping the shape of (batch, 1, 1, channels) for the broadcast in the scaling
+    z = tf.reduce_mean(input, axis=[1, 2], keepdims=True)
+    # Excitation; the matmuls act on the last axis like 1x1 convs
+    s = tf.sigmoid(tf.matmul(tf.nn.relu(tf.matmul(z, self.w1) + self.b1), self.w2) + self.b2)
+    # Scale
+    return input * s
+
+class SEResNet_Block(ResNet_Block):
   def __init__(self, filter_size=16, kernel_size=(3,3), strides=(1,1)):
-    ''' args:
+    ''' ResNet_Block with a SE block.
+      args:
          filter_size: numbers of output filters.
          kernel_size: kernel_size. default is (3,3)
          strides: turple. If this is not (1,1), skip connection are replaced to convolution layer and it makes an output downsized.
     '''
-    super(SEResNet_Block, self).__init__()
-
-    self.norm1 = layers.BatchNormalization()
-    self.act1 = layers.Activation(tf.nn.relu)
-    self.conv1 = layers.Conv2D(filter_size, kernel_size, strides=strides, padding='same')
-
-    if strides == (1,1):
-      self.shortcutblock = [layers.Identity()]
-    else:
-      self.shortcutblock = [
-          layers.BatchNormalization(),
-          layers.Activation(tf.nn.relu),
-          layers.Conv2D(filter_size, (1,1), strides=strides, padding='same')
-       ]
-
-    self.norm2 = layers.BatchNormalization()
-    self.act2 = layers.Activation(tf.nn.relu)
-    self.conv2 = layers.Conv2D(filter_size, kernel_size, strides=(1,1), padding='same')
-
-    self.seblock = SE_Block(filter_size)
-
-    self.add = layers.Add()
-
-  def call(self, input):
-    # Residual Block
-    x = self.norm1(input, training=False)
-    x = self.act1(x)
-    x = self.conv1(x)
-
-    x = self.norm2(x, training=False)
-    x = self.act2(x)
-    x = self.conv2(x)
-
-    # SE block
-    x = self.seblock(x)
-
-    # Skip Connection Block
-    skip = input
-    for layer in self.shortcutblock:
-      skip = layer(skip)
-
-    x = self.add([x, skip])
-
-    return x
+    super(SEResNet_Block, self).__init__(filter_size, kernel_size, strides, se=True)
 
 class ResNet_Blocks(layers.Layer):
   def __init__(self, num_filters, resnet=None, depth=0):
@@ -236,23 +350,33 @@ class ResNet_Blocks(layers.Layer):
     # depth: int. Number of blocks.
 
     # ResNet Block
-    if not resnet:
-      self.block = [tf.keras.layers.Identity()]
-    elif 'se' in resnet.lower():
-      self.block = [
-          SEResNet_Block(num_filters) for _ in range(depth)
-      ]
-    else:
-      self.block = [
-          ResNet_Block(num_filters) for _ in range(depth)
-      ]
-
-  def call(self, x):
-    for layer in self.block:
-      x = layer(x)
-    return x
-
-
+    self.block = make_stage(resnet_block_class(resnet), num_filters, depth) or [tf.keras.layers.Identity()]
+
+  def call(self, x, training=None):
+    return apply_layers(self.block, x, training)
+
+def resnet_block_class(resnet):
+  '''Returns SEResNet_Block if resnet contains 'SE', ResNet_Block if it contains 'Res', otherwise None. Case insensitive.'''
+  resnet = (resnet or '').lower()
+  if 'se' in resnet:
+    return SEResNet_Block
+  elif 'res' in resnet:
+    return ResNet_Block
+  return None
+
+def make_stage(block_cls, filters, n):
+  '''Returns a list of n new residual blocks of block_cls with filters, or an empty list if block_cls is None.'''
+  if not block_cls:
+    return []
+  return [block_cls(filters) for _ in range(n)]
+
+def flatten_blocks(*blocks):
+  '''Returns the layers of the sequential blocks as one list, leaving out the Identity layers.
+  arguments:
+    blocks: Initial_Block, TransConv_Block, Conv_Block, Header_Block or ResNet_Blocks layers.
+  '''
+  sublayers = itertools.chain.from_iterable(block.conv_block if isinstance(block, Conv_Block) else block.block for block in blocks)
+  return [layer for layer in sublayers if not isinstance(layer, layers.Identity)]
 
 def build_generator(
         latent_dim = 100, # Dimension of random noise (latent space vectors)
@@ -263,16 +387,17 @@ def build_generator(
         activation='LeakyReLU', # Activation for the generator
         dense=True,
         resnet = '',
+        upsampling = 'subpixel',
         ):
 
   '''Generator Model for DCGAN
-  The generator uses tf.keras.layers.Conv2DTranspose (upsampling) layers to produce an image from a seed (random noise),
+  The generator uses upsampling layers (SubPixelConv2D or tf.keras.layers.Conv2DTranspose) to produce an image from a seed (random noise),
   which is a vector with the dimension of latent_dim.
 
   Start with a Dense layer that takes this seed as input.
   Project the output of the dense layer to a project_shape that is defined by project_size and channels.
   ex: project_size=[4, 4] and channels=3 make project_shape=[4, 4, 3].
-  Upsample 4 times through Conv2DTranspose layer. This process generates an image that is 2 to the power of 4 times larger than the input.
+  Upsample 4 times through the upsampling layer. This process generates an image that is 2 to the power of 4 times larger than the input.
   As project_shape=[4, 4, 3] the image generated has the shpae of [64, 64, 3].
   Notice the tf.keras.layers.LeakyReLU or the tf.keras.layers.ReLU activation for each layer, except the output layer which uses tanh.
   The default is ReLU.
@@ -286,71 +411,136 @@ def build_generator(
     activation: str: Str, the activation functions for each layer except the output layer. If you specify "LeakyReLU", the activations are LeakyReLU, otherwise ReLU.
     dense: Boolean, whether the 1st layer is a Dense layer. If False, the 1st layer is a Conv2DTranspose layer.
     resnet: Str, ResNet is adopted when 'Res', SEResnet is adopted when 'SE', None is none adopt.
+    upsampling: Str, 'subpixel' upsamples with SubPixelConv2D, 'transpose' with Conv2DTranspose.
   '''
-  # Project size
-  project_size = [x//16 for x in image_size]
-  # Project shape
-  project_shape = project_size + [num_filters*16]
-  dense_units = project_size[0] * project_size[1] * num_filters*16
+  # Layer classes, looked up once. '' or None gives ReLU here, unlike in the blocks.
+  act_cls = activation_class(activation) or layers.ReLU
+  block_cls = resnet_block_class(resnet)
+
+  # Project size, project shape and dense units
+  project_size, project_shape, dense_units, _ = derive_shapes(tuple(image_size), num_filters*16, channels)
 
   model = tf.keras.Sequential()
 
   if dense:
-    model.add(tf.keras.layers.Dense(dense_units, use_bias=False, input_dim=latent_dim))
+    model.add(Projection(dense_units, input_dim=latent_dim))
   else:
     model.add(tf.keras.layers.Input(shape=(latent_dim)))
     model.add(tf.keras.layers.Reshape((1,1,latent_dim)))
     model.add(tf.keras.layers.Conv2DTranspose(num_filters*16, project_size, strides=(1, 1), padding='valid', use_bias=False))
 
-  model.add(tf.keras.layers.BatchNormalization())
+  # The fused kernel needs 4D input, which the output of the projection is not.
+  model.add(tf.keras.layers.BatchNormalization(fused=not dense, momentum=0.9, epsilon=1e-5))
 
-  if 'leakyrelu' == activation.lower():
-    activation_layer = tf.keras.layers.LeakyReLU()
-  else:
-    activation_layer = tf.keras.layers.ReLU()
-  model.add(activation_layer)
+  model.add(act_cls())
   model.add(tf.keras.layers.Reshape(project_shape))
 
   # ResNet
-  if 'se' in resnet.lower():
-    model.add(SEResNet_Block(num_filters*16))
-  elif 'res' in resnet.lower():
-    model.add(ResNet_Block(num_filters*16))
-  else:
-    pass
+  if block_cls:
+    model.add(block_cls(num_filters*16))
 
   # conv1
-  model.add(tf.keras.layers.Conv2DTranspose(num_filters*8, gen_kernel_size, strides=(2, 2), padding='same', use_bias=False))
-  model.add(tf.keras.layers.BatchNormalization())
-  if 'leakyrelu' == activation.lower():
-    activation_layer = tf.keras.layers.LeakyReLU()
-  else:
-    activation_layer = tf.keras.layers.ReLU()
-  model.add(activation_layer)
+  model.add(upsampling_layer(num_filters*8, gen_kernel_size, upsampling, use_bias=False))
+  model.add(tf.keras.layers.BatchNormalization(fused=True, momentum=0.9, epsilon=1e-5))
+  model.add(act_cls())
 
   # conv2
-  model.add(tf.keras.layers.Conv2DTranspose(num_filters*4, gen_kernel_size, strides=(2, 2), padding='same', use_bias=False))
-  model.add(tf.keras.layers.BatchNormalization())
-  if 'leakyrelu' == activation.lower():
-    activation_layer = tf.keras.layers.LeakyReLU()
-  else:
-    activation_layer = tf.keras.layers.ReLU()
-  model.add(activation_layer)
+  model.add(upsampling_layer(num_filters*4, gen_kernel_size, upsampling, use_bias=False))
+  model.add(tf.keras.layers.BatchNormalization(fused=True, momentum=0.9, epsilon=1e-5))
+  model.add(act_cls())
 
   # conv4
-  model.add(tf.keras.layers.Conv2DTranspose(num_filters*2, gen_kernel_size, strides=(2, 2), padding='same', use_bias=False))
-  model.add(tf.keras.layers.BatchNormalization())
-  if 'leakyrelu' == activation.lower():
-    activation_layer = tf.keras.layers.LeakyReLU()
-  else:
-    activation_layer = tf.keras.layers.ReLU()
-  model.add(activation_layer)
+  model.add(upsampling_layer(num_filters*2, gen_kernel_size, upsampling, use_bias=False))
+  model.add(tf.keras.layers.BatchNormalization(fused=True, momentum=0.9, epsilon=1e-5))
+  model.add(act_cls())
 
   # conv5
-  model.add(tf.keras.layers.Conv2DTranspose(channels, gen_kernel_size, strides=(2, 2), padding='same', use_bias=False, activation='tanh'))
+  # The output is kept in float32 under mixed precision.
+  model.add(upsampling_layer(channels, gen_kernel_size, upsampling, use_bias=False, activation='tanh', dtype='float32'))
 
   return model
 
+def fold_bn_into_convtranspose(model):
+  '''Folds the BatchNormalization following each upsampling conv of a trained generator into the conv for inference.
+  Each Conv2DTranspose or SubPixelConv2D -> BatchNormalization (-> LeakyReLU/ReLU) run is replaced by a single conv
+  of the same kind with bias and the activation fused in, so every upsampling stage runs as one op:
+    W' = W * gamma / sqrt(var + eps)
+    b' = beta + (b - mean) * gamma / sqrt(var + eps)
+  The other layers are shared with model.
+
+  arguments:
+    model: Tf.Sequential. Trained generator, e.g. from build_generator.
+
+  Returns:
+    Tf.Sequential for inference.
+  '''
+  model_layers = list(model.layers)
+  folded = [tf.keras.Input(shape=model.input_shape[1:])]
+
+  i = 0
+  while i < len(model_layers):
+    layer = model_layers[i]
+    if not (isinstance(layer, (layers.Conv2DTranspose, SubPixelConv2D)) and i+1 < len(model_layers) and isinstance(model_layers[i+1], layers.BatchNormalization)):
+      folded.append(layer)
+      i += 1
+      continue
+
+    bn = model_layers[i+1]
+    i += 2
+
+    # Activation following the batch norm
+    activation = layer.activation
+    if i < len(model_layers) and isinstance(model_layers[i], layers.LeakyReLU):
+      alpha = float(model_layers[i].alpha)
+      activation = lambda x, alpha=alpha: tf.nn.leaky_relu(x, alpha=alpha)
+      i += 1
+    elif i < len(model_layers) and isinstance(model_layers[i], layers.ReLU):
+      activation = tf.nn.relu
+      i += 1
+
+    gamma = bn.gamma.numpy() if bn.scale else 1.
+    beta = bn.beta.numpy() if bn.center else 0.
+    factor = gamma / np.sqrt(bn.moving_variance.numpy() + bn.epsilon)
+    shift = beta - bn.moving_mean.numpy() * factor
+
+    if isinstance(layer, SubPixelConv2D):
+      config = layer.get_config()
+      config.update(name=layer.name + '_folded', use_bias=True, activation=None)
+      conv = SubPixelConv2D.from_config(config)
+      conv.build(layer.input_shape)
+      conv.activation = activation
+      # The scale**2 sub-pixels of an output channel share its batch norm.
+      factor, shift = np.tile(factor, layer.scale**2), np.tile(shift, layer.scale**2)
+      bias = layer.conv.bias.numpy() if layer.conv.use_bias else 0.
+      # The kernel of Conv2D has the shape of (height, width, in_channels, out_channels).
+      conv.conv.set_weights([layer.conv.kernel.numpy() * factor, shift + bias * factor])
+    else:
+      config = layer.get_config()
+      config.update(name=layer.name + '_folded', use_bias=True, activation=None)
+      conv = layers.Conv2DTranspose.from_config(config)
+      conv.activation = activation
+      conv.build(layer.input_shape)
+      bias = layer.bias.numpy() if layer.use_bias else 0.
+      # The kernel of Conv2DTranspose has the shape of (height, width, out_channels, in_channels).
+      conv.set_weights([layer.kernel.numpy() * factor[:, np.newaxis], shift + bias * factor])
+    folded.append(conv)
+
+  return tf.keras.Sequential(folded)
+
+def fold_all_bn(model):
+  '''Folds the batch norms of all residual blocks of a trained model into their convs for inference.
+  Each ResNet_Block or SEResNet_Block is replaced by its folded_copy, which has one batch norm less.
+  The other layers are shared with model.
+
+  arguments:
+    model: Tf.Model. SEResNet_generator, SEResNet_discriminator, or a Sequential model, e.g. from build_generator.
+
+  Returns:
+    Tf.Sequential for inference.
+  '''
+  model_layers = getattr(model, 'pipeline', model).layers
+  return tf.keras.Sequential([layer.folded_copy() if isinstance(layer, ResNet_Block) else layer for layer in model_layers])
+
 def build_discriminator(
         image_size = (64, 64), # Image size
         channels = 3, # Number of channels of images
@@ -378,7 +568,7 @@ def build_discriminator(
     dense: Boolean, whether use a Dense layer for output. If False, the last output layer is a Conv2D layer.
   '''
   # Input Shape
-  input_shape = list(image_size) + [channels]
+  input_shape = derive_shapes(tuple(image_size), num_filters, channels).input_shape
 
   model = tf.keras.Sequential()
 
@@ -407,7 +597,7 @@ def build_discriminator(
     model.add(tf.keras.layers.AveragePooling2D(pool_size=(2, 2)))
 
   if batchnorm:
-    model.add(tf.keras.layers.BatchNormalization())
+    model.add(tf.keras.layers.BatchNormalization(fused=True, momentum=0.9, epsilon=1e-5))
 
   model.add(tf.keras.layers.LeakyReLU())
 
@@ -422,7 +612,7 @@ def build_discriminator(
     model.add(tf.keras.layers.AveragePooling2D(pool_size=(2, 2)))
 
   if batchnorm:
-    model.add(tf.keras.layers.BatchNormalization())
+    model.add(tf.keras.layers.BatchNormalization(fused=True, momentum=0.9, epsilon=1e-5))
 
   model.add(tf.keras.layers.LeakyReLU())
 
@@ -437,7 +627,7 @@ def build_discriminator(
     model.add(tf.keras.layers.AveragePooling2D(pool_size=(2, 2)))
 
   if batchnorm:
-    model.add(tf.keras.layers.BatchNormalization())
+    model.add(tf.keras.layers.BatchNormalization(fused=True, momentum=0.9, epsilon=1e-5))
 
   model.add(tf.keras.layers.LeakyReLU())
 
@@ -445,15 +635,104 @@ def build_discriminator(
     model.add(tf.keras.layers.Dropout(dropout_rate))
 
   # Output
+  # The logits are kept in float32 under mixed precision.
   if dense:
     model.add(tf.keras.layers.Flatten())
-    model.add(tf.keras.layers.Dense(1))
+    model.add(tf.keras.layers.Dense(1, dtype='float32'))
   else:
-    model.add(tf.keras.layers.Conv2D(1, disc_kernel_size, strides=(2, 2), padding='valid'))
-    model.add(tf.keras.layers.GlobalAveragePooling2D())
+    model.add(tf.keras.layers.Conv2D(1, disc_kernel_size, strides=(2, 2), padding='valid', dtype='float32'))
+    model.add(tf.keras.layers.GlobalAveragePooling2D(dtype='float32'))
 
   return model
 
+def representative_dataset_gen(images, num_samples=100):
+  '''Returns a representative dataset for quantize_discriminator.
+  arguments:
+    images: Array or Tensor of images in the input range of the model, with the shape of (num_images, height, width, channels).
+    num_samples: Int. Number of images used to calibrate the activation ranges.
+  '''
+  def gen():
+    for image in images[:num_samples]:
+      yield [tf.cast(image[tf.newaxis], tf.float32)]
+  return gen
+
+def quantize_discriminator(model, representative_dataset):
+  '''Post-training INT8 quantization of a discriminator for CPU and Edge TPU inference.
+  Weights and activations are quantized to int8, also the input and the output.
+  The converter traces the model in inference mode, so Dropout is dropped and BatchNormalization is folded into the convs.
+  Build the model with the 'float32' policy, since the float16 casts of mixed precision can not be quantized.
+
+  arguments:
+    model: Tf.Model. Discriminator, e.g. from build_discriminator.
+    representative_dataset: Callable returning a generator of calibration inputs, e.g. from representative_dataset_gen.
+
+  Returns:
+    The TFLite flatbuffer as bytes.
+  '''
+  converter = tf.lite.TFLiteConverter.from_keras_model(model)
+  converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  converter.representative_dataset = representative_dataset
+  converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+  converter.inference_input_type = tf.int8
+  converter.inference_output_type = tf.int8
+  return converter.convert()
+
+def export_for_cpu(model, representative_dataset, out_dir):
+  '''Exports a model as an INT8 quantized OpenVINO IR for CPU inference, e.g. the discriminator from build_discriminator.
+  The model is saved as a SavedModel to out_dir, converted to OpenVINO, quantized with NNCF on the representative dataset,
+  and saved to out_dir/openvino/model.xml. The IR runs as a single OpenVINO inference request using the int8 dot product
+  instructions (AVX-512 VNNI, AMX) of the CPU.
+  Requires openvino and nncf. Build the model with the 'float32' policy.
+
+  arguments:
+    model: Tf.Model. Model to export.
+    representative_dataset: Callable returning a generator of calibration inputs, e.g. from representative_dataset_gen.
+    out_dir: String. Directory to save the SavedModel and the OpenVINO IR to.
+
+  Returns:
+    The quantized openvino.Model.
+  '''
+  import nncf
+  import openvino
+
+  tf.saved_model.save(model, out_dir)
+  ov_model = openvino.convert_model(out_dir)
+
+  # The generator yields lists of inputs; the model has a single input.
+  calibration_dataset = nncf.Dataset(list(representative_dataset()), lambda inputs: inputs[0].numpy())
+  quantized = nncf.quantize(ov_model, calibration_dataset)
+
+  openvino.save_model(quantized, os.path.join(out_dir, 'openvino', 'model.xml'))
+  return quantized
+
+def recast_discriminator(model, skip_layers=(0,)):
+  '''Quantization aware version of a discriminator with int8 convs.
+  Every Conv2D layer except those in skip_layers gets int8 fake quantization of its weights and activations,
+  so that fine-tuning the returned model adapts it to int8 before it is converted with quantize_discriminator.
+  The first conv is skipped by default; it sees the raw images and is the most sensitive to quantization.
+  Requires tensorflow_model_optimization.
+
+  arguments:
+    model: Tf.Model. Sequential or functional discriminator, e.g. from build_discriminator, built with the 'float32' policy.
+    skip_layers: Tuple of Int. Indices of the Conv2D layers, counted among the Conv2D layers only, which are left in float.
+
+  Returns:
+    Quantization aware Tf.Model, initialized with a copy of the weights of model. The weights are not shared:
+    training model afterwards is not reflected in the returned model, and vice versa.
+  '''
+  import tensorflow_model_optimization as tfmot
+
+  conv_layers = [layer for layer in model.layers if isinstance(layer, layers.Conv2D)]
+  skip = [conv_layers[i] for i in skip_layers]
+
+  def annotate(layer):
+    if isinstance(layer, layers.Conv2D) and not any(layer is s for s in skip):
+      return tfmot.quantization.keras.quantize_annotate_layer(layer)
+    return layer
+
+  annotated = tf.keras.models.clone_model(model, clone_function=annotate)
+  return tfmot.quantization.keras.quantize_apply(annotated)
+
 class SEResNet_generator(tf.keras.Model):
   '''Generator Model for DCGAN with SE-ResNet
   A Deep Convolutional(DC) generator uses tf.keras.layers.Conv2DTranspose (upsampling) layers to produce an image from a seed (random noise),
@@ -479,36 +758,42 @@ class SEResNet_generator(tf.keras.Model):
           dense=True,
           resnet = None,
           depths=[1,0,0], # List of number of blocks
+          upsampling='subpixel', # 'subpixel' or 'transpose', see upsampling_layer
           ):
     super().__init__()
     
     # Initial Block
     self.initial_block = Initial_Block(latent_dim, image_size, num_filters*16, kernel_size, activation, dense)
     # ResNet Block 1
+    # The tower runs at 1/16 of the image size, so its activations are small enough to stay in the GPU L2 cache.
+    # TF has no access to the CUDA L2 persistence window; instead the whole tower is compiled into the XLA cluster
+    # of call, so the activations are passed between fused kernels without extra copies.
     self.res_block1 = ResNet_Blocks(num_filters*16, resnet, depths[0])
     # conv block1
-    self.conv_block1 = TransConv_Block(num_filters*8, kernel_size, activation)
+    self.conv_block1 = TransConv_Block(num_filters*8, kernel_size, activation, upsampling=upsampling)
     # ResNet Block 2
     self.res_block2 = ResNet_Blocks(num_filters*8, resnet, depths[1])
     # conv2
-    self.conv_block2 = TransConv_Block(num_filters*4, kernel_size, activation)
+    self.conv_block2 = TransConv_Block(num_filters*4, kernel_size, activation, upsampling=upsampling)
     # ResNet Block 3
     self.res_block3 = ResNet_Blocks(num_filters*4, resnet, depths[2])
     # conv3
-    self.conv_block3 = TransConv_Block(num_filters*2, kernel_size, activation)
+    self.conv_block3 = TransConv_Block(num_filters*2, kernel_size, activation, upsampling=upsampling)
     # conv4
-    self.conv_block4 = TransConv_Block(channels, kernel_size, activation='tanh', batchnorm=False)
+    self.conv_block4 = TransConv_Block(channels, kernel_size, activation='tanh', batchnorm=False, dtype='float32', upsampling=upsampling)
 
-  def call(self, x):
-    x = self.initial_block(x)
-    x = self.res_block1(x)
-    x = self.conv_block1(x)
-    x = self.res_block2(x)
-    x = self.conv_block2(x)
-    x = self.res_block3(x)
-    x = self.conv_block3(x)
-    x = self.conv_block4(x)
-    return x
+    # The layers of all blocks in order as one Sequential model, which call runs in a single invocation.
+    self.pipeline = tf.keras.Sequential(flatten_blocks(
+        self.initial_block,
+        self.res_block1, self.conv_block1,
+        self.res_block2, self.conv_block2,
+        self.res_block3, self.conv_block3,
+        self.conv_block4,
+    ), name='pipeline')
+
+  @tf.function(jit_compile=True, reduce_retracing=True)
+  def call(self, x, training=None):
+    return self.pipeline(x, training=training)
 
 class SEResNet_discriminator(tf.keras.Model):
   '''The Discriminator
@@ -541,9 +826,6 @@ class SEResNet_discriminator(tf.keras.Model):
         ):
     super().__init__()
 
-    # Input Shape
-    input_shape = list(image_size) + [channels]
-
 
     if pooling:
       strides=(1,1)
@@ -568,15 +850,16 @@ class SEResNet_discriminator(tf.keras.Model):
     self.res_block4 = ResNet_Blocks(num_filters*8, resnet, depth=depths[3])
     # Header block
     self.header_block = Header_Block(dense, kernel_size)
-  
-  def call(self, x):
-    x = self.conv_block1(x)
-    x = self.res_block1(x)
-    x = self.conv_block2(x)
-    x = self.res_block2(x)
-    x = self.conv_block3(x)
-    x = self.res_block3(x)
-    x = self.conv_block4(x)
-    x = self.res_block4(x)
-    x = self.header_block(x)
-    return x
+
+    # The layers of all blocks in order as one Sequential model, which call runs in a single invocation.
+    self.pipeline = tf.keras.Sequential(flatten_blocks(
+        self.conv_block1, self.res_block1,
+        self.conv_block2, self.res_block2,
+        self.conv_block3, self.res_block3,
+        self.conv_block4, self.res_block4,
+        self.header_block,
+    ), name='pipeline')
+
+  @tf.function(jit_compile=True, reduce_retracing=True)
+  def call(self, x, training=None):
+    return self.pipeline(x, training=training)
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('matplotlib')
+pytest.importorskip('IPython')
+
+from cyclegan.CycleGan import CycleGanTraining
+
+
+def tiny_model(activation):
+  # Dense acts on the channel axis like a 1x1 conv; the output is kept in float32 as in the real models.
+  return tf.keras.Sequential([
+      tf.keras.layers.Input((8, 8, 3)),
+      tf.keras.layers.Dense(3),
+      tf.keras.layers.Activation(activation, dtype='float32'),
+  ])
+
+
+@pytest.fixture
+def mixed_float16():
+  tf.keras.mixed_precision.set_global_policy('mixed_float16')
+  yield
+  tf.keras.mixed_precision.set_global_policy('float32')
+
+
+def test_overflow_only_skips_the_network_that_overflowed(mixed_float16):
+  model = CycleGanTraining(tiny_model('tanh'), tiny_model('tanh'), tiny_model('linear'), tiny_model('linear'))
+  assert model.loss_scale
+
+  # Inject an overflow into discriminator Y only: with this scale its float16 gradients become inf.
+  model.discriminator_y_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(
+      tf.keras.optimizers.Adam(), dynamic=True, initial_scale=2.**40)
+  x_scale = float(model.discriminator_x_optimizer.loss_scale)
+
+  x_weights = [w.numpy() for w in model.discriminator_x.trainable_variables]
+  y_weights = [w.numpy() for w in model.discriminator_y.trainable_variables]
+
+  rng = np.random.default_rng(0)
+  data = tuple(tf.constant(rng.integers(0, 256, (2, 8, 8, 3)), tf.uint8) for _ in range(2))
+  model.train_step(data)
+
+  # Y skips the step and lowers its own scale.
+  assert float(model.discriminator_y_optimizer.loss_scale) == 2.**39
+  for before, after in zip(y_weights, model.discriminator_y.trainable_variables):
+    np.testing.assert_array_equal(before, after.numpy())
+
+  # X is unaffected: it keeps its scale and is updated.
+  assert float(model.discriminator_x_optimizer.loss_scale) == x_scale
+  assert any(not np.array_equal(before, after.numpy())
+             for before, after in zip(x_weights, model.discriminator_x.trainable_variables))
@@ -1,6 +1,52 @@
+import os
+
 import tensorflow as tf
 from tensorflow.keras import layers
 
+# Compile the transformer blocks and the discriminator forward pass with XLA.
+# Set VIT_DISC_JIT_COMPILE=0 to fall back to plain graph mode if XLA regresses.
+JIT_COMPILE = os.environ.get('VIT_DISC_JIT_COMPILE', '1') != '0'
+
+# Mixed precision is opt-in: call utilities.precision.set_mixed_precision_policy() before building the discriminator.
+# The attention and MLP matmuls then run in bfloat16 or float16 while the variables stay in float32.
+# Softmax, layer norm statistics and the head are kept in float32.
+
+def blockwise_attention(q, k, v, block_size=64):
+  '''Softmax attention over key/value blocks without materializing the full attention matrix.
+
+    The keys and values are visited in blocks of block_size with the online softmax recurrence:
+    a running max m, a running sum of exponentials l and an unnormalized output o, all in float32.
+    The number of tokens is static, so the loop unrolls and XLA fuses each block.
+
+    Args:
+      q: Tensor with the shape (batch_size, num_patches, num_heads, head_dim), already scaled.
+      k: Tensor with the shape (batch_size, num_keys, num_heads, head_dim).
+      v: Tensor with the shape (batch_size, num_keys, num_heads, head_dim).
+      block_size: Int. Number of keys per block.
+
+    Returns:
+      Tensor with the shape (batch_size, num_patches, num_heads, head_dim).
+  '''
+  m = l = o = None
+  for start in range(0, k.shape[1], block_size):
+    k_block = k[:, start:start+block_size]
+    v_block = v[:, start:start+block_size]
+    s = tf.cast(tf.einsum('bnhd,bmhd->bhnm', q, k_block), tf.float32) # (batch_size, num_heads, num_patches, block_size)
+    m_block = tf.reduce_max(s, axis=-1, keepdims=True)
+    m_new = m_block if m is None else tf.maximum(m, m_block)
+    p = tf.exp(s - m_new)
+    o_block = tf.cast(tf.einsum('bhnm,bmhd->bhnd', tf.cast(p, v.dtype), v_block), tf.float32)
+    if m is None:
+      l = tf.reduce_sum(p, axis=-1, keepdims=True)
+      o = o_block
+    else:
+      # Rescale what has been accumulated to the new running max
+      correction = tf.exp(m - m_new)
+      l = l * correction + tf.reduce_sum(p, axis=-1, keepdims=True)
+      o = o * correction + o_block
+    m = m_new
+  return tf.cast(tf.transpose(o / l, (0, 2, 1, 3)), q.dtype)
+
 class SelfAttention_layer(layers.Layer):
 
   '''Self Attention.
@@ -11,52 +57,80 @@ class SelfAttention_layer(layers.Layer):
       qkv_bias: Boolean, whether the dense layers use bias vectors/matrices in MultiHeadAttention.
       attn_p : Float. Dropout probability applied to the query, key and value tensors.
       proj_p : Float. Dropout probability applied to the output tensor.
+      block_size : Int. Sequences longer than this, without attention dropout, use blockwise_attention
+        with key/value blocks of this size.
   '''
   
-  def __init__(self, dim, num_heads=12, qkv_bias=True, attn_p=0., proj_p=0.):
+  def __init__(self, dim, num_heads=12, qkv_bias=True, attn_p=0., proj_p=0., block_size=64):
     super().__init__()
     self.num_heads = num_heads
+    self.attn_p = attn_p
+    self.block_size = block_size
     self.dim = dim
     self.head_dim = dim // num_heads
     self.scale = self.head_dim ** -0.5
+    self.qkv_bias = qkv_bias
 
-    self.qkv_layer = tf.keras.layers.Dense(dim*3, use_bias=qkv_bias, input_shape=(None, dim))
     self.attn_drop_layer = tf.keras.layers.Dropout(attn_p)
-    self.proj_layer = tf.keras.layers.Dense(dim)
     self.proj_drop_layer = tf.keras.layers.Dropout(proj_p, input_shape=(None, dim))
-      
 
-  def call(self, input):
+  def build(self, input_shape):
+    # The projection kernels are held with the contracted feature axis last, (..., in_dim),
+    # so both einsum operands are stride-1 along the contraction and the heads come out split.
+    # Glorot-uniform limits are those of the equivalent Dense(dim*3) and Dense(dim).
+    qkv_limit = (6. / (self.dim + self.dim*3)) ** 0.5
+    proj_limit = (6. / (self.dim + self.dim)) ** 0.5
+    self.qkv_kernel = self.add_weight(
+        name='qkv_kernel', shape=(3, self.num_heads, self.head_dim, self.dim),
+        initializer=tf.keras.initializers.RandomUniform(-qkv_limit, qkv_limit), trainable=True)
+    if self.qkv_bias:
+      self.qkv_bias_weight = self.add_weight(
+          name='qkv_bias', shape=(3, 1, 1, self.num_heads, self.head_dim), initializer='zeros', trainable=True)
+    self.proj_kernel = self.add_weight(
+        name='proj_kernel', shape=(self.dim, self.num_heads, self.head_dim),
+        initializer=tf.keras.initializers.RandomUniform(-proj_limit, proj_limit), trainable=True)
+    self.proj_bias = self.add_weight(name='proj_bias', shape=(self.dim,), initializer='zeros', trainable=True)
+
+  def call(self, input, training=None):
     '''
       Args:
           input: Tensor whith the shape `(batch_size, num_patches, dim)`.
+          training: Boolean. Whether the dropout layers run in training mode.
 
       Returns
           output: Tensor with the shape `(batch_size, num_patches, dim)`.
     '''
 
-    b, n, c = input.shape
-    qkv = self.qkv_layer(input)  # (batch_size, num_patches, dim*3)
-    qkv = tf.reshape(qkv, (b, n, 3, self.num_heads, self.head_dim)) # (batch_size, num_patches, 3, num_heads, head_dim)
-    qkv = tf.transpose(qkv, (2, 0, 3, 1, 4)) # (3, batch_size, num_heads, num_patches, head_dim)
-    q, k, v = qkv[0], qkv[1], qkv[2] 
+    qkv = tf.einsum('bnc,shdc->sbnhd', input, self.qkv_kernel) # (3, batch_size, num_patches, num_heads, head_dim)
+    if self.qkv_bias:
+      qkv = qkv + self.qkv_bias_weight
+    q, k, v = tf.unstack(qkv) # (batch_size, num_patches, num_heads, head_dim)
 
-    # Scaled-dot product
-    dp = tf.matmul(q, k, transpose_b=True) * self.scale # (batch_size, num_heads, num_patches, num_patches)
+    # The scale goes on q, (num_patches, head_dim) per head, rather than on the
+    # (num_patches, num_patches) scores, and fuses into the projection output
+    q = q * self.scale
 
-    # Calc attention weight 
-    attention_weight = tf.nn.softmax(dp, axis=-1)
+    if self.attn_p == 0. and input.shape[1] > self.block_size:
+      # Long sequences, e.g. the unwindowed stages: never hold the whole attention matrix
+      attention_ouptput = blockwise_attention(q, k, v, self.block_size)
+      output = tf.einsum('bnhd,ehd->bne', attention_ouptput, self.proj_kernel) + self.proj_bias
+      return self.proj_drop_layer(output, training=training)
+
+    # Scaled-dot product, all heads in one batched contraction
+    dp = tf.einsum('bnhd,bmhd->bhnm', q, k) # (batch_size, num_heads, num_patches, num_patches)
+
+    # Calc attention weight, in float32 for a stable softmax under mixed precision
+    attention_weight = tf.cast(tf.nn.softmax(tf.cast(dp, tf.float32), axis=-1), dp.dtype)
 
     # Drop out applied to attention weight
-    attention_weight = self.attn_drop_layer(attention_weight)
+    attention_weight = self.attn_drop_layer(attention_weight, training=training)
     
     # Attention pooling
-    attention_ouptput = tf.matmul(attention_weight, v) # (batch_size, num_heads, num_patches, head_dim)
-    attention_ouptput = tf.transpose(attention_ouptput, (0, 2, 1, 3))
-    attention_ouptput = tf.reshape(attention_ouptput, (b,n,c))  # (batch_size, num_patches, dim)
-    
-    output = self.proj_layer(attention_ouptput)  # (batch_size, num_patches, dim)
-    output = self.proj_drop_layer(output)
+    attention_ouptput = tf.einsum('bhnm,bmhd->bnhd', attention_weight, v) # (batch_size, num_patches, num_heads, head_dim)
+
+    # Output projection merges the heads in the same contraction, no reshape needed
+    output = tf.einsum('bnhd,ehd->bne', attention_ouptput, self.proj_kernel) + self.proj_bias  # (batch_size, num_patches, dim)
+    output = self.proj_drop_layer(output, training=training)
 
     return output
 
@@ -98,20 +172,21 @@ class CrossAttention_layer(layers.Layer):
           output: Tensor with the shape `(batch_size, num_patches, dim)`.
     '''
     
-    b, n, c = input.shape
-    b, e_n, e_c = embedding.shape
+    # Static token and feature dims; the batch dim is left to the reshapes as -1
+    _, n, c = input.shape
+    _, e_n, e_c = embedding.shape
 
     
     q = self.q_layer(input)  # (batch_size, num_patches, que_dim)
-    q = tf.reshape(q,(b, n, self.num_heads, self.head_dim))
+    q = tf.reshape(q,(-1, n, self.num_heads, self.head_dim))
     q = tf.transpose(q, (0, 2, 1, 3)) # (batch_size, num_heads, num_patches, head_dim)
     
     k = self.k_layer(embedding)  # (batch_size, num_patches, key_dim)
-    k = tf.reshape(k,(b, e_n, self.num_heads, self.head_dim))
+    k = tf.reshape(k,(-1, e_n, self.num_heads, self.head_dim))
     k = tf.transpose(k, (0, 2, 1, 3)) # (batch_size, num_heads, num_embed, head_dim)
     
     v = self.k_layer(embedding)  # (batch_size, num_patches, key_dim)
-    v = tf.reshape(v,(b, e_n, self.num_heads, self.head_dim))
+    v = tf.reshape(v,(-1, e_n, self.num_heads, self.head_dim))
     v = tf.transpose(v, (0, 2, 1, 3)) # (batch_size, num_heads, num_embed, head_dim)
 
     # Scaled-dot product
@@ -126,13 +201,83 @@ class CrossAttention_layer(layers.Layer):
     # Attention pooling
     attention_ouptput = tf.matmul(attention_weight, v) # (batch_size, num_heads, num_patches, head_dim)
     attention_ouptput = tf.transpose(attention_ouptput, (0, 2, 1, 3))
-    attention_ouptput = tf.reshape(attention_ouptput, (b, n, self.que_dim))  # (batch_size, num_patches, que_dim)
+    attention_ouptput = tf.reshape(attention_ouptput, (-1, n, self.que_dim))  # (batch_size, num_patches, que_dim)
     
     output = self.proj_layer(attention_ouptput)  # (batch_size, num_patches, que_dim)
     output = self.proj_drop_layer(output)
 
     return input + output
 
+class FusedLayerNorm(layers.Layer):
+  '''Layer normalization over the last axis computed by a single fused batch norm kernel.
+
+    The tokens are laid out as the channels of a (1, tokens, features, 1) NCHW tensor, so the
+    per-channel statistics of fused_batch_norm are the per-token statistics over the features.
+
+    Args:
+      epsilon: Float. Small constant added to the variance.
+  '''
+  def __init__(self, epsilon=1e-6):
+    super().__init__()
+    self.epsilon = epsilon
+
+  def build(self, input_shape):
+    self.gamma = self.add_weight(name='gamma', shape=(input_shape[-1],), initializer='ones', trainable=True)
+    self.beta = self.add_weight(name='beta', shape=(input_shape[-1],), initializer='zeros', trainable=True)
+
+  def call(self, x):
+    shape = tf.shape(x)
+    # Normalize in float32 under mixed precision
+    y = tf.reshape(tf.cast(x, tf.float32), (1, -1, x.shape[-1], 1))
+    tokens = tf.shape(y)[1]
+    # Unit scale and zero offset here; the learned affine is applied per feature below
+    y, _, _ = tf.compat.v1.nn.fused_batch_norm(
+        y, tf.ones([tokens], dtype=tf.float32), tf.zeros([tokens], dtype=tf.float32),
+        epsilon=self.epsilon, data_format='NCHW')
+    y = tf.cast(tf.reshape(y, shape), x.dtype)
+    return y * self.gamma + self.beta
+
+class LN_MLP_Block(layers.Layer):
+  '''Layer normalization followed by the MLP, compiled as one XLA region.
+
+    The normalization statistics, the affine, both matmuls with their biases and the
+    tanh GELU are plain ops on raw weights, so XLA can fuse them into a couple of kernels.
+
+    Args:
+      embed_dim: Int. Embeddinig dimension.
+      mlp_ratio: Int, the factor for determination of the hidden dimension size of the MLP.
+      dropout_rate: Float. Dropout rate.
+      epsilon: Float. Small constant added to the variance in the normalization.
+  '''
+  def __init__(self, embed_dim, mlp_ratio=4, dropout_rate=0., epsilon=1e-6):
+    super().__init__()
+    self.embed_dim = embed_dim
+    self.hidden_dim = embed_dim * mlp_ratio
+    self.epsilon = epsilon
+    self.drop_1 = layers.Dropout(dropout_rate)
+    self.drop_2 = layers.Dropout(dropout_rate)
+
+  def build(self, input_shape):
+    self.gamma = self.add_weight(name='gamma', shape=(self.embed_dim,), initializer='ones', trainable=True)
+    self.beta = self.add_weight(name='beta', shape=(self.embed_dim,), initializer='zeros', trainable=True)
+    self.w1 = self.add_weight(name='w1', shape=(self.embed_dim, self.hidden_dim), initializer='glorot_uniform', trainable=True)
+    self.b1 = self.add_weight(name='b1', shape=(self.hidden_dim,), initializer='zeros', trainable=True)
+    self.w2 = self.add_weight(name='w2', shape=(self.hidden_dim, self.embed_dim), initializer='glorot_uniform', trainable=True)
+    self.b2 = self.add_weight(name='b2', shape=(self.embed_dim,), initializer='zeros', trainable=True)
+
+  @tf.function(jit_compile=JIT_COMPILE, reduce_retracing=True)
+  def call(self, x, training=None):
+    # Layer normalization
+    mean, variance = tf.nn.moments(tf.cast(x, tf.float32), axes=[-1], keepdims=True)
+    x = (x - tf.cast(mean, x.dtype)) * tf.cast(tf.math.rsqrt(variance + self.epsilon), x.dtype) * self.gamma + self.beta
+
+    # MLP, the activation applied after both dense layers as in MLP_layer, with the same exact (erf) gelu
+    x = tf.nn.gelu(tf.matmul(x, self.w1) + self.b1, approximate=False)
+    x = self.drop_1(x, training=training)
+    x = tf.nn.gelu(tf.matmul(x, self.w2) + self.b2, approximate=False)
+    x = self.drop_2(x, training=training)
+    return x
+
 class Block(layers.Layer):
   '''Transformer block.
 
@@ -150,35 +295,31 @@ class Block(layers.Layer):
   def __init__(self, embed_dim, num_heads=4, mlp_ratio=4, mlp_drop=0., qkv_bias=False, attn_drop=0., activation='gelu'):
     super().__init__()
 
-    self.LN1 = layers.LayerNormalization(epsilon=1e-6)
+    self.LN1 = FusedLayerNorm(epsilon=1e-6)
 
-    self.MHA =layers.MultiHeadAttention(
-        num_heads=num_heads, key_dim=embed_dim, use_bias=qkv_bias, dropout=attn_drop,
+    self.attention = SelfAttention_layer(
+        dim=embed_dim, num_heads=num_heads, qkv_bias=qkv_bias, attn_p=attn_drop,
     )
 
-    self.LN2 = layers.LayerNormalization(epsilon=1e-6)
-
-    hidden_units = [embed_dim * mlp_ratio, embed_dim]
-    self.MLP = MLP_layer(hidden_units=hidden_units, dropout_rate=mlp_drop, activation='gelu')
+    # Layer normalization 2 and the MLP in one fused region
+    self.ln_mlp = LN_MLP_Block(embed_dim, mlp_ratio=mlp_ratio, dropout_rate=mlp_drop, epsilon=1e-6)
 
-  def call(self, encoded_patches):
+  @tf.function(jit_compile=JIT_COMPILE, reduce_retracing=True)
+  def call(self, encoded_patches, training=None):
     # Layer normalization 1.
     x1 = self.LN1(encoded_patches)
 
-    # Create a multi-head attention layer.
-    attention_output = self.MHA(x1, x1)
+    # Multi-head self attention.
+    attention_output = self.attention(x1, training=training)
     
     # Skip connection 1.
-    x2 = layers.Add()([attention_output, encoded_patches])
+    x2 = attention_output + encoded_patches
 
-    # Layer normalization 2.
-    x3 = self.LN2(x2)
-    
-    # MLP.
-    x3 = self.MLP(x3)
+    # Layer normalization 2 and MLP.
+    x3 = self.ln_mlp(x2, training=training)
     
     # Skip connection 2.
-    out = layers.Add()([x3, x2])
+    out = x3 + x2
 
     return out
 
@@ -223,6 +364,56 @@ class DropPath(tf.keras.layers.Layer):
     def call(self, x, training=False):
         return drop_path(x, self.drop_prob, training)
 
+def window_partition(x, window_size):
+  """
+    Args:
+      x: (B, H, W, C)
+      window_size (int): window size
+    Returns:
+      windows: (num_windows*B, window_size*window_size, C)
+  """
+  # One reshape, one transpose and one reshape; H, W and C are static, only B is inferred
+  _, H, W, C = x.shape
+  x = tf.reshape(x, (-1, H//window_size, window_size, W//window_size, window_size, C))
+  x = tf.transpose(x, (0, 1, 3, 2, 4, 5))
+  return tf.reshape(x, (-1, window_size*window_size, C))
+
+def window_reverse(x, window_size, H, W):
+  """
+    Args:
+      x: (num_windows*B, window_size*window_size, C)
+      window_size (int): Window size
+      H (int): Height of image
+      W (int): Width of image
+    Returns:
+      x: (B, H, W, C)
+  """
+  C = x.shape[-1]
+  x = tf.reshape(x, (-1, H//window_size, W//window_size, window_size, window_size, C))
+  x = tf.transpose(x, (0, 1, 3, 2, 4, 5))
+  return tf.reshape(x, (-1, H, W, C))
+
+def window_reverse_pool(x, window_size, H, W):
+  """Window reverse followed by a 2x average pool, as one strided reduce.
+
+    The 2x2 means are taken inside the windows before the transpose, so only the pooled
+    map is permuted and the full-resolution (B, H, W, C) map is never written.
+
+    Args:
+      x: (num_windows*B, window_size*window_size, C)
+      window_size (int): Window size, even
+      H (int): Height of image
+      W (int): Width of image
+    Returns:
+      x: (B, H//2, W//2, C)
+  """
+  C = x.shape[-1]
+  half = window_size//2
+  x = tf.reshape(x, (-1, H//window_size, W//window_size, half, 2, half, 2, C))
+  x = tf.reduce_mean(x, axis=[4, 6])
+  x = tf.transpose(x, (0, 1, 3, 2, 4, 5))
+  return tf.reshape(x, (-1, H//2, W//2, C))
+
 class WindowPartition_layer(layers.Layer):
   """
   Args:
@@ -242,12 +433,7 @@ class WindowPartition_layer(layers.Layer):
       Returns:
         windows: (num_windows*B, window_size*window_size, C)
     """
-    B, H, W, C = x.shape
-    x = tf.reshape(x, (B, H//self.window_size, self.window_size, W//self.window_size, self.window_size, C))
-    x = tf.transpose(x,(0, 1, 3, 2, 4, 5))
-    x = tf.reshape(x, (-1, self.window_size, self.window_size, C))
-    x = tf.reshape(x, (-1, self.window_size*self.window_size, C))
-    return x
+    return window_partition(x, self.window_size)
 
 class WindowReverse_layer(layers.Layer):
   def __init__(self, window_size, H, W):
@@ -270,15 +456,7 @@ class WindowReverse_layer(layers.Layer):
     Args:
       x: (num_windows*B, window_size*window_size, C)
     """
-    C = x.shape[-1]
-    num_windows = (self.H//self.window_size)*(self.W//self.window_size)
-    B = x.shape[0] // num_windows
-
-    x = tf.reshape(x, (-1, self.window_size, self.window_size, C))
-    x = tf.reshape(x, (B, self.H//self.window_size, self.W//self.window_size, self.window_size, self.window_size, -1))
-    x = tf.transpose(x, (0, 1, 3, 2, 4, 5))
-    x = tf.reshape(x, (B, self.H, self.W, -1))
-    return x
+    return window_reverse(x, self.window_size, self.H, self.W)
 
 class PatchEmbed_layer(layers.Layer):
   '''Divide an image into patches
@@ -325,13 +503,14 @@ class PatchEmbed_layer(layers.Layer):
     # Split into patches and Project to a vector with embed dimensional. 
     self.projection = tf.keras.layers.Conv2D(filters=embed_dim, kernel_size=kernel_size, strides=patch_size, padding=padding)
 
+  def build(self, input_shape):
     # Position Embed
-    if add_pos:
-      self.pos_embed = tf.Variable(tf.zeros((1, num_patches, embed_dim), dtype=tf.dtypes.float32))
-    
+    if self.add_pos:
+      self.pos_embed = self.add_weight(
+          name='pos_embed', shape=(1, self.num_patches, self.embed_dim), initializer='zeros', trainable=True)
+
   def call(self, images):
-    # batch_size = tf.shape(images)[0]
-    batch_size = images.shape[0]
+    batch_size = tf.shape(images)[0]
     x = self.projection(images)
     x = tf.reshape(x, (batch_size, -1, self.embed_dim))
     if self.add_pos:
@@ -341,20 +520,54 @@ class PatchEmbed_layer(layers.Layer):
 class AddPositionEmbed_layer(layers.Layer):
   def __init__(self, num_patches, embed_dim):
     super().__init__()
-    self.pos_embed = tf.Variable(tf.zeros((1, num_patches, embed_dim), dtype=tf.dtypes.float32))
+    self.num_patches = num_patches
+    self.embed_dim = embed_dim
+
+  def build(self, input_shape):
+    self.pos_embed = self.add_weight(
+        name='pos_embed', shape=(1, self.num_patches, self.embed_dim), initializer='zeros', trainable=True)
 
   def call(self, x):
     return x + self.pos_embed
 
-class AddCLSToken_layer(layers.Layer):
-  def __init__(self, embed_dim):
+class SequentialBlocks(layers.Layer):
+  '''Transformer blocks applied in turn, compiled as one XLA program.
+
+    The blocks are fixed when the call is traced, so the loop unrolls in the compiled
+    program and XLA can fuse across block boundaries.
+
+    Args:
+      blocks: List of Block.
+  '''
+  def __init__(self, blocks):
     super().__init__()
-    self.cls_token = tf.Variable(tf.zeros((1, 1, embed_dim), dtype=tf.dtypes.float32))
+    self.blocks = list(blocks)
 
-  def call(self, x):
-    batch_size = x.shape[0]
-    return tf.concat([tf.tile(self.cls_token, [batch_size, 1, 1]), x], axis=1)
+  @tf.function(jit_compile=JIT_COMPILE, reduce_retracing=True)
+  def call(self, x, training=None):
+    for block in self.blocks:
+      x = block(x, training=training)
+    return x
+
+def grid_block(x, blocks, window_size, pool=False, training=None):
+  '''Runs transformer blocks on the windows of a grid.
 
+    Args:
+      x: Tensor with the shape (B, H, W, C).
+      blocks: SequentialBlocks applied to the windows.
+      window_size: Int, grid size for grid transformer block.
+      pool: Boolean. If True, the output is 2x average pooled while reversing the windows.
+      training: Boolean. Whether the dropout layers run in training mode.
+
+    Returns:
+      Tensor with the shape (B, H, W, C), or (B, H//2, W//2, C) if pool.
+  '''
+  # Partition once and reverse once; the blocks run back to back on the windows
+  _, H, W, _ = x.shape
+  x = blocks(window_partition(x, window_size), training=training)
+  if pool:
+    return window_reverse_pool(x, window_size, H, W)
+  return window_reverse(x, window_size, H, W)
 
 class discriminator(tf.keras.Model):
   '''Discriminator with a Vision Transformer (ViT).
@@ -396,6 +609,7 @@ class discriminator(tf.keras.Model):
       mlp_ratio: Int, the factor for determination of the hidden dimension size of the MLP module with respect to embed_dim.
       attn_drop : Float. Dropout probability applied to MultiHeadAttention.
       window_size: Int, grid size for grid transformer block.
+      tie_weights: Boolean. If True, the blocks of each stage share the weights of one Block.
         
         
   '''
@@ -412,6 +626,7 @@ class discriminator(tf.keras.Model):
       mlp_ratio = 4,
       attn_drop = 0.,
       window_size = 4,
+      tie_weights = False,
       ):
     
     super().__init__()
@@ -427,13 +642,15 @@ class discriminator(tf.keras.Model):
     self.patch_size_2 = patch_size_2 = patch_size*2
     self.patch_size_3 = patch_size_3 = patch_size*4
 
+    # Only the first stage reads the image. The coarser stage embeddings are pooled from
+    # its feature map and projected per token, instead of running two more conv stems.
     self.patches_1 = PatchEmbed_layer(image_size, patch_size = patch_size_1, embed_dim = embed_dim_1, kernel_size = patch_size_1*2, padding='same')
-    self.patches_2 = PatchEmbed_layer(image_size, patch_size = patch_size_2, embed_dim = embed_dim_2, kernel_size = patch_size_2, padding='valid')
-    self.patches_3 = PatchEmbed_layer(image_size, patch_size = patch_size_3, embed_dim = embed_dim_3, kernel_size = patch_size_3, padding='valid')
+    self.stem_proj_2 = layers.Dense(embed_dim_2)
+    self.stem_proj_3 = layers.Dense(embed_dim_3)
 
     num_patches_1 = self.patches_1.num_patches
-    num_patches_2 = self.patches_2.num_patches
-    num_patches_3 = self.patches_3.num_patches
+    num_patches_2 = (image_size[0]//patch_size_2)*(image_size[1]//patch_size_2)
+    num_patches_3 = (image_size[0]//patch_size_3)*(image_size[1]//patch_size_3)
 
     self.add_pos_embed_1 = AddPositionEmbed_layer(num_patches_1, embed_dim_1)
     self.add_pos_embed_2 = AddPositionEmbed_layer(num_patches_2, embed_dim_2)
@@ -441,113 +658,81 @@ class discriminator(tf.keras.Model):
 
     self.window_size = window_size
 
-    self.blocks_1 = [
-        Block(
-            embed_dim=embed_dim_1, num_heads=num_heads, mlp_ratio=mlp_ratio, mlp_drop=mlp_drop, qkv_bias=False, attn_drop=attn_drop, activation='gelu'
-        ) for _ in range(depth)
-    ]
+    def stage_blocks(dim, depth):
+      # With tied weights one Block is applied depth times; Keras tracks its weights once
+      make_block = lambda: Block(
+          embed_dim=dim, num_heads=num_heads, mlp_ratio=mlp_ratio, mlp_drop=mlp_drop, qkv_bias=False, attn_drop=attn_drop, activation='gelu'
+      )
+      if tie_weights:
+        return SequentialBlocks([make_block()] * depth)
+      return SequentialBlocks([make_block() for _ in range(depth)])
+
+    self.blocks_1 = stage_blocks(embed_dim_1, depth)
     
-    self.blocks_2 = [
-        Block(
-            embed_dim=embed_dim_1+embed_dim_2, num_heads=num_heads, mlp_ratio=mlp_ratio, mlp_drop=mlp_drop, qkv_bias=False, attn_drop=attn_drop, activation='gelu'
-        ) for _ in range(depth-1)
-    ]
+    self.blocks_2 = stage_blocks(embed_dim_1+embed_dim_2, depth-1)
     
-    self.blocks_21 = [
-        Block(
-            embed_dim=embed_dim_1+embed_dim_2, num_heads=num_heads, mlp_ratio=mlp_ratio, mlp_drop=mlp_drop, qkv_bias=False, attn_drop=attn_drop, activation='gelu'
-        ) for _ in range(1)
-    ]
+    self.blocks_21 = stage_blocks(embed_dim_1+embed_dim_2, 1)
     
-    self.blocks_3 = [
-        Block(
-            embed_dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, mlp_drop=mlp_drop, qkv_bias=False, attn_drop=attn_drop, activation='gelu'
-        ) for _ in range(depth)
-    ]
+    self.blocks_3 = stage_blocks(embed_dim, depth)
 
+    # The head reads the mean of the tokens, so no CLS token or extra block over N+1 tokens
+    self.layer_norm = FusedLayerNorm(epsilon=1e-6)
 
-    self.add_cls_token = AddCLSToken_layer(embed_dim=embed_dim)
+    # float32 logits for the loss
+    self.head = layers.Dense(num_classes, dtype='float32')
 
-    self.blocks_last = [
-        Block(
-            embed_dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, mlp_drop=mlp_drop, qkv_bias=False, attn_drop=attn_drop, activation='gelue'
-        )
-    ]
-
-    self.layer_norm = layers.LayerNormalization(epsilon=1e-6)
-
-    self.head = layers.Dense(num_classes)
-
-  def call(self, input):
-    batch_size, height, width, channels = input.shape
+  @tf.function(jit_compile=JIT_COMPILE, reduce_retracing=True)
+  def call(self, input, training=None):
+    # Only the spatial dims need to be static; the batch dim may vary.
+    _, height, width, channels = input.shape
     h = height//self.patch_size_1
     w = width//self.patch_size_1
 
     x_1 = self.patches_1(input)
-    x_2 = self.patches_2(input)
-    x_3 = self.patches_3(input)
 
-    # B, H//2*W//2, embed_dim//4 if patch_size = 2
-    x = self.add_pos_embed_1(x_1)
-    c = x.shape[-1]
+    # The grid stages stay in (B, H, W, C) from here to the first non-grid block;
+    # tokens are only flattened where a plain transformer block needs them.
+
+    # Stage 2 and 3 embeddings: 2x pooled views of the stage 1 map, projected per token
+    # B, H//4, W//4, embed_dim//4 and B, H//8, W//8, embed_dim//2 if patch_size = 2
+    x_2 = self.stem_proj_2(tf.nn.avg_pool2d(tf.reshape(x_1, (-1, h, w, self.embed_dim_1)), 2, 2, 'VALID'))
+    x_3 = self.stem_proj_3(tf.nn.avg_pool2d(x_2, 2, 2, 'VALID'))
 
-    # -- Grid Transformer Block --
     # B, H//2, W//2, embed_dim//4 if patch_size = 2
-    x = layers.Reshape((h, w, c))(x)
-    x = WindowPartition_layer(self.window_size)(x)
-    for block in self.blocks_1:
-      x = block(x)
-    x = WindowReverse_layer(self.window_size, h, w)(x)
+    x = tf.reshape(self.add_pos_embed_1(x_1), (-1, h, w, self.embed_dim_1))
 
-    # -- 2x AvePool --
+    # -- Grid Transformer Block and 2x AvePool --
     # B, H//4, W//4, embed_dim//4
-    x = layers.AveragePooling2D(2)(x)
-    _, h, w, c = x.shape
+    x = grid_block(x, self.blocks_1, self.window_size, pool=True, training=training)
 
-    #  -- Concatnate --
-    # B, H//4*W//4, embed_dim//4
-    x = layers.Reshape((-1, c))(x)
-    # B, H//4*W//4, embed_dim//2
-    x = layers.Concatenate(axis=-1)([x, x_2])
-    c = x.shape[-1]
+    # -- Concatnate --
+    # B, H//4, W//4, embed_dim//2
+    x = tf.concat([x, x_2], axis=-1)
+    _, h, w, c = x.shape
 
     # -- Grid Transformer Block --
-    x = layers.Reshape((h, w, c))(x)
-    x = WindowPartition_layer(self.window_size)(x)
-    for block in self.blocks_2:
-      x = block(x)
-    x = WindowReverse_layer(self.window_size, h, w)(x)    
+    x = grid_block(x, self.blocks_2, self.window_size, training=training)
+
     # -- Transformer Block --
-    x = layers.Reshape((h*w, c))(x)
-    for block in self.blocks_21:
-      x = block(x)
-
-    # -- 2x AvePool --
-    x = layers.Reshape((h, w, c))(x)
-    # B, H//8, W//8, embed_dim//2
-    x = layers.AveragePooling2D(2)(x)
+    x = tf.reshape(x, (-1, h*w, c))
+    x = self.blocks_21(x, training=training)
+
+    # -- 2x AvePool and Concatnate --
+    # Strided mean straight from the tokens: B, H//8, W//8, embed_dim//2
+    x = tf.reduce_mean(tf.reshape(x, (-1, h//2, 2, w//2, 2, c)), axis=[2, 4])
+    # B, H//8, W//8, embed_dim
+    x = tf.concat([x, x_3], axis=-1)
     _, h, w, c = x.shape
-
-    #  -- Concatnate --
-    x = layers.Reshape((-1, c))(x)
     # B, H//8*W//8, embed_dim
-    x = layers.Concatenate(axis=-1)([x, x_3])
-    c = x.shape[-1]
-
-    # -- Transformer Block --
-    for block in self.blocks_3:
-      x = block(x)
-
-    # -- Add CLS token --
-    # B, H//8*W//8+1, embed_dim
-    x = self.add_cls_token(x)
+    x = tf.reshape(x, (-1, h*w, c))
 
     # -- Transformer Block --
-    for block in self.blocks_last:
-      x = block(x)
+    x = self.blocks_3(x, training=training)
 
+    # -- Mean pool and head --
+    # B, embed_dim
     x = self.layer_norm(x)
-    x = self.head(x[:,0])
+    x = self.head(tf.reduce_mean(x, axis=1))
 
     return x
 
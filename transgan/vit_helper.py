@@ -43,14 +43,13 @@ class SelfAttention_layer(layers.Layer):
           output: Tensor with the shape `(batch_size, num_patches, dim)`.
     '''
 
-    b, n, c = input.shape
+    _, n, c = input.shape
     qkv = self.qkv_layer(input)  # (batch_size, num_patches, dim*3)
-    qkv = tf.reshape(qkv, (b, n, 3, self.num_heads, self.head_dim)) # (batch_size, num_patches, 3, num_heads, head_dim)
-    qkv = tf.transpose(qkv, (2, 0, 3, 1, 4)) # (3, batch_size, num_heads, num_patches, head_dim)
-    q, k, v = qkv[0], qkv[1], qkv[2] 
+    qkv = tf.reshape(qkv, (-1, n, 3, self.num_heads, self.head_dim)) # (batch_size, num_patches, 3, num_heads, head_dim)
+    q, k, v = tf.unstack(qkv, axis=2) # (batch_size, num_patches, num_heads, head_dim)
 
-    # Scaled-dot product
-    x = tf.matmul(q, k, transpose_b=True) * self.scale # (batch_size, num_heads, num_patches, num_patches)
+    # Scaled-dot product, all heads in one batched contraction
+    x = tf.einsum('bnhd,bmhd->bhnm', q, k) * self.scale # (batch_size, num_heads, num_patches, num_patches)
 
     # Calc attention weight 
     x = tf.nn.softmax(x, axis=-1)
@@ -59,9 +58,8 @@ class SelfAttention_layer(layers.Layer):
     x = self.attn_drop_layer(x)
     
     # Attention pooling
-    x = tf.matmul(x, v) # (batch_size, num_heads, num_patches, head_dim)
-    x = tf.transpose(x, (0, 2, 1, 3))
-    x = tf.reshape(x, (b,n,c))  # (batch_size, num_patches, dim)
+    x = tf.einsum('bhnm,bmhd->bnhd', x, v) # (batch_size, num_patches, num_heads, head_dim)
+    x = tf.reshape(x, (-1, n, c))  # (batch_size, num_patches, dim)
     
     x = self.proj_layer(x)  # (batch_size, num_patches, dim)
     x = self.proj_drop_layer(x)
@@ -114,20 +112,21 @@ class CrossAttention_layer(layers.Layer):
           output: Tensor with the shape `(batch_size, num_patches, dim)`.
     '''
     
-    b, n, c = input.shape
-    b, e_n, e_c = embedding.shape
+    # Static token and feature dims; the batch dim is left to the reshapes as -1
+    _, n, c = input.shape
+    _, e_n, e_c = embedding.shape
 
     
     q = self.q_layer(input)  # (batch_size, num_patches, que_dim)
-    q = tf.reshape(q,(b, n, self.num_heads, self.head_dim))
+    q = tf.reshape(q,(-1, n, self.num_heads, self.head_dim))
     q = tf.transpose(q, (0, 2, 1, 3)) # (batch_size, num_heads, num_patches, head_dim)
     
     k = self.k_layer(embedding)  # (batch_size, num_patches, key_dim)
-    k = tf.reshape(k,(b, e_n, self.num_heads, self.head_dim))
+    k = tf.reshape(k,(-1, e_n, self.num_heads, self.head_dim))
     k = tf.transpose(k, (0, 2, 1, 3)) # (batch_size, num_heads, num_embed, head_dim)
     
     v = self.k_layer(embedding)  # (batch_size, num_patches, key_dim)
-    v = tf.reshape(v,(b, e_n, self.num_heads, self.head_dim))
+    v = tf.reshape(v,(-1, e_n, self.num_heads, self.head_dim))
     v = tf.transpose(v, (0, 2, 1, 3)) # (batch_size, num_heads, num_embed, head_dim)
 
     # Scaled-dot product
@@ -142,7 +141,7 @@ class CrossAttention_layer(layers.Layer):
     # Attention pooling
     x = tf.matmul(x, v) # (batch_size, num_heads, num_patches, head_dim)
     x = tf.transpose(x, (0, 2, 1, 3))
-    x = tf.reshape(x, (b, n, self.que_dim))  # (batch_size, num_patches, que_dim)
+    x = tf.reshape(x, (-1, n, self.que_dim))  # (batch_size, num_patches, que_dim)
     
     x = self.proj_layer(x)  # (batch_size, num_patches, que_dim)
     x = self.proj_drop_layer(x)
@@ -169,8 +168,8 @@ class WindowPartition_layer(layers.Layer):
       Returns:
         windows: (num_windows*B, window_size*window_size, C)
     """
-    B, H, W, C = x.shape
-    x = tf.reshape(x, (B, H//self.window_size, self.window_size, W//self.window_size, self.window_size, C))
+    _, H, W, C = x.shape
+    x = tf.reshape(x, (-1, H//self.window_size, self.window_size, W//self.window_size, self.window_size, C))
     x = tf.transpose(x,(0, 1, 3, 2, 4, 5))
     x = tf.reshape(x, (-1, self.window_size, self.window_size, C))
     x = tf.reshape(x, (-1, self.window_size*self.window_size, C))
@@ -198,13 +197,11 @@ class WindowReverse_layer(layers.Layer):
       x: (num_windows*B, window_size*window_size, C)
     """
     C = x.shape[-1]
-    num_windows = (self.H//self.window_size)*(self.W//self.window_size)
-    B = x.shape[0] // num_windows
 
     x = tf.reshape(x, (-1, self.window_size, self.window_size, C))
-    x = tf.reshape(x, (B, self.H//self.window_size, self.W//self.window_size, self.window_size, self.window_size, -1))
+    x = tf.reshape(x, (-1, self.H//self.window_size, self.W//self.window_size, self.window_size, self.window_size, C))
     x = tf.transpose(x, (0, 1, 3, 2, 4, 5))
-    x = tf.reshape(x, (B, self.H, self.W, -1))
+    x = tf.reshape(x, (-1, self.H, self.W, C))
     return x
 
 class MLP_layer(layers.Layer):
@@ -279,15 +276,15 @@ class PixelShuffle_layer(layers.Layer):
     self.kernel_size = kernel_size
   
   def call(self, inputs):
-    batch_size, height, width, in_channels = inputs.shape
+    _, height, width, in_channels = inputs.shape
     out_channels = in_channels // (self.scale**2)
 
     # Reshape to (batch_size, height, width, scale, scale, out_channels)
-    x = tf.reshape(inputs, [batch_size, height, width, self.scale, self.scale, out_channels])
+    x = tf.reshape(inputs, [-1, height, width, self.scale, self.scale, out_channels])
 
     # Transpose to (batch_size, height*scale, width*scale, out_channels)
     x = tf.transpose(x, [0, 1, 3, 2, 4, 5])
-    x = tf.reshape(x, [batch_size, height * self.scale, width * self.scale, out_channels])
+    x = tf.reshape(x, [-1, height * self.scale, width * self.scale, out_channels])
 
     return x
 
@@ -0,0 +1,29 @@
+import tensorflow as tf
+
+def set_mixed_precision_policy(policy=None):
+  """Sets the global Keras mixed precision policy.
+
+  Call this before building the generators and discriminators so that their layers
+  compute in float16/bfloat16 while keeping the variables in float32.
+
+  Args:
+    policy: Str. Name of the policy, e.g. 'mixed_float16' or 'mixed_bfloat16'.
+      If None, 'mixed_bfloat16' is chosen on Ampere or newer GPUs (no loss scaling needed),
+      'mixed_float16' on older GPUs, and 'float32' when no GPU is available.
+
+  Returns:
+    The global tf.keras.mixed_precision.Policy.
+  """
+  if policy is None:
+    policy = 'float32'
+    for device in tf.config.list_physical_devices('GPU'):
+      compute_capability = tf.config.experimental.get_device_details(device).get('compute_capability', (0, 0))
+      if compute_capability >= (8, 0):
+        policy = 'mixed_bfloat16'
+      else:
+        policy = 'mixed_float16'
+        break
+
+  tf.keras.mixed_precision.set_global_policy(policy)
+  tf.get_logger().info('Mixed precision policy: %s', policy)
+  return tf.keras.mixed_precision.global_policy()